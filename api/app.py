@@ -4,6 +4,7 @@ import sqlalchemy
 from .routes import auth, api
 from .swagger import swag
 from .models import db, User
+from .catalog import build_classroom_catalog
 from cards.id import load_id_json_file, decode_public_id
 import os
 import sys
@@ -112,9 +113,11 @@ def init_and_generate():
             'Generating Initial Data for Database '
             f'(DB_GEN_POLICY: {policy})')
         generate()
-    elif policy != 'never' and policy != 'first_time':
-        current_app.logger.warning(
-            f'Unknown DB_GEN_POLICY: {policy}. Treated as \'never\'.')
+    else:
+        if policy != 'never' and policy != 'first_time':
+            current_app.logger.warning(
+                f'Unknown DB_GEN_POLICY: {policy}. Treated as \'never\'.')
+        build_classroom_catalog()
 
 
 def initdb(app, db):
@@ -127,6 +130,7 @@ def generate():
         1. generate classrooms
         2. generate lotteries
         3. generate users
+        4. rebuild the classroom catalog
 
         Args:
             no-args needed
@@ -178,3 +182,5 @@ def generate():
         db.session.add(error)
 
     db.session.commit()
+
+    build_classroom_catalog()
@@ -0,0 +1,79 @@
+from collections import namedtuple
+from types import MappingProxyType
+import base64
+from flask import current_app
+from api.models import Classroom
+
+__docs__ = """in-process catalog of classrooms
+
+    Classrooms are written only by `generate()`, so they are read once
+    with their titles decoded and kept in the application, to serve
+    /classrooms and the classroom parts of lotteries without the DB.
+    The catalog is built when the DB is initialized before the first
+    request and rebuilt by `generate()`. Other processes, like
+    `flask generate`, can't rebuild it: restart the server after them.
+"""
+
+ClassroomEntry = namedtuple('ClassroomEntry',
+                            ['id', 'grade', 'index', 'title', 'name'])
+
+
+class ClassroomCatalog:
+    """immutable snapshot of the classrooms
+        Attributes:
+            classrooms (tuple of ClassroomEntry): classrooms in id order
+            by_id (mapping): ClassroomEntry by classroom id
+    """
+    def __init__(self, classrooms):
+        self.classrooms = tuple(
+            ClassroomEntry(
+                id=classroom.id, grade=classroom.grade,
+                index=classroom.index,
+                title=classroom.title and
+                base64.b64decode(classroom.title).decode('utf-8'),
+                name=classroom.get_classroom_name())
+            for classroom in classrooms)
+        self.by_id = MappingProxyType(
+            {entry.id: entry for entry in self.classrooms})
+
+    def __len__(self):
+        return len(self.classrooms)
+
+
+def build_classroom_catalog():
+    """
+        read the classrooms and keep them as the catalog of the application.
+        application context is required
+        Return:
+          catalog(ClassroomCatalog): the new catalog
+    """
+    catalog = ClassroomCatalog(Classroom.query.order_by(Classroom.id))
+    current_app.extensions['classroom_catalog'] = catalog
+    return catalog
+
+
+def get_classroom_catalog():
+    """
+        the catalog of the application, built if it is not yet
+        Return:
+          catalog(ClassroomCatalog): the catalog
+    """
+    catalog = current_app.extensions.get('classroom_catalog')
+    if catalog is None:
+        catalog = build_classroom_catalog()
+    return catalog
+
+
+def find_classroom(classroom_id):
+    """
+        the classroom in the catalog.
+        the catalog is rebuilt once if the classroom is not found in it
+        Args:
+          classroom_id(int): id of the classroom
+        Return:
+          classroom(ClassroomEntry): the classroom, or None if not found
+    """
+    entry = get_classroom_catalog().by_id.get(classroom_id)
+    if entry is None:
+        entry = build_classroom_catalog().by_id.get(classroom_id)
+    return entry
@@ -21,6 +21,26 @@ class BaseConfig(object):
     CLASSROOM_TABLE_FILE = ROOT_DIR / Path('classrooms.json')
     WINNERS_NUM = 85
     WAITING_NUM = 30
+    # number of lotteries drawn at the same time in /draw_all
+    DRAW_PARALLELISM = int(os.getenv('DRAW_PARALLELISM', '1'))
+    # 'python': draw with api.draw_engine
+    # 'sql': draw inside the database (PostgreSQL only), see api.draw_sql.
+    #        it is seeded from the same root seed, but its results differ
+    #        from 'python': groups get no priority, and seats left by
+    #        a group crossing WINNERS_NUM are not given to the next ones
+    DRAW_BACKEND = os.getenv('DRAW_BACKEND', 'python')
+    # enqueue draws requested through the API into the draw_job table
+    # instead of drawing in the request. run `flask draw-worker` with it
+    DRAW_JOB_QUEUE = os.getenv('DRAW_JOB_QUEUE', 'false') == 'true'
+    # seconds without a heartbeat after which a running draw job is
+    # considered abandoned by a dead worker and queued again
+    DRAW_JOB_TIMEOUT = int(os.getenv('DRAW_JOB_TIMEOUT', '600'))
+    # root seed of draws. a random seed is made and recorded for each day
+    # in the draw_seed table when not set
+    DRAW_ROOT_SEED = os.getenv('DRAW_ROOT_SEED')
+    # draw lotteries in advance when applications are closed,
+    # in `flask draw-worker` (see api.scheduler)
+    PRE_DRAW = os.getenv('PRE_DRAW', 'false') == 'true'
     RECAPTCHA_SECRET_KEY = os.environ.get('RECAPTCHA_SECRET_KEY')
     RECAPTCHA_THRESHOLD = 0.09  # more than 0.09
     TIMEZONE = timezone(timedelta(hours=+9), 'JST')
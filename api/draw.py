@@ -1,206 +1,485 @@
-import random
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from flask import current_app
-from api.models import Lottery, Application, db
-from itertools import chain
-from numpy.random import choice
+from sqlalchemy import case, func
+from api.models import (
+    Lottery,
+    User,
+    Application,
+    DrawRun,
+    StatusTransitions,
+    db
+)
+from api import draw_sql
+from api.draw_lock import lottery_lock
+from api.draw_rng import get_root_entropy, lottery_rng, lottery_seed
+from api.draw_engine import (
+    GroupAdvantage,
+    STATUS_NAMES,
+    WON,
+    WAITING,
+    load_frame,
+    draw_frame,
+    statuses_from_ranks,
+    write_ranks,
+    write_results
+)
 from api.time_management import get_current_datetime
+from api.utils import count_queries, PhaseTimer
 
 
-class GroupAdvantage:
-    @staticmethod
-    def minimum(group):
-        return min(app.get_advantage() for app in group)
-
-    @staticmethod
-    def average(group):
-        group = list(group)
-        return sum(app.get_advantage() for app in group) / len(group)
-
-    @staticmethod
-    def rep(group):
-        return next(filter(lambda app: app.is_rep, group)).get_advantage()
+group_advantage_calculation = GroupAdvantage.average
 
 
-group_advantage_calculation = GroupAdvantage.average
+def calc_group_advantage(rep_application, member_applications):
+    """
+        advantage shared by the group, with `group_advantage_calculation`.
+        recorded on the rep when the group applies
+        Args:
+          rep_application(Application): application of the rep
+          member_applications([Application]): applications of the members
+        Return:
+          advantage(float): the advantage of the group
+    """
+    applications = [rep_application] + list(member_applications)
+    advantages = np.array([app.advantage for app in applications],
+                          dtype=float)
+    groups = np.zeros(len(applications), dtype=int)
+    is_rep = np.arange(len(applications)) == 0
+    return float(group_advantage_calculation(advantages, groups, is_rep)[0])
 
 
-def draw_one(lottery):
+def draw_one(lottery, rng=None):
     """
-        Draw the specified lottery
+        Draw the specified lottery.
+        If the lottery is already staged by `stage_one`,
+        the staged ranks are published without drawing again.
+        The lottery is locked while it is drawn, and a lottery
+        already drawn is not drawn again: its winners are returned.
+        Timings of each phase are recorded as a `DrawRun`
         Args:
           lottery(Lottery): The lottery to be drawn
+          rng(numpy.random.Generator): source of randomness.
+                                       the stream of the lottery if None
         Return:
           applications([User]): The list of applications handled
     """
-    idx = lottery.id
-    applications = (
-        Application.query
-        .filter_by(lottery_id=idx, created_on=get_current_datetime().date())
-        .all()
-    )
+    with lottery_lock(lottery):
+        winners = drawn_winners(lottery)
+        if winners is None:
+            winners = _draw_one(lottery, rng)
 
-    if len(applications) == 0:
-        winners = []
-    else:
-        set_group_advantage(applications)
+    if not winners:
+        return []
+    return User.query.filter(User.id.in_(winners)).all()
 
-        winners_num = current_app.config['WINNERS_NUM']
-        waiting_num = current_app.config['WAITING_NUM']
 
-        won_group_members = draw_one_group_members(
-            applications, winners_num, set_just=True,
-            target_status="pending", win_status="won",
-            lose_status="waiting-pending")
+def _draw_one(lottery, rng):
+    """internal function
+        draw the lottery holding its lock
+        Return:
+          winners([int]): ids of users who won
+    """
+    winners_num = current_app.config['WINNERS_NUM']
+    waiting_num = current_app.config['WAITING_NUM']
+    run = DrawRun(lottery_id=lottery.id)
+    timer = PhaseTimer()
+
+    with count_queries(db.engine) as statements:
+        if use_sql_backend() and not is_staged(lottery):
+            run.mode = 'sql'
+            winners = draw_sql.draw_one_sql(lottery, winners_num,
+                                            waiting_num,
+                                            group_advantage_calculation,
+                                            _lottery_seed(lottery, run))
+            timer.lap('draw')
+        else:
+            frame = load_frame(lottery)
+            timer.lap('load')
+            if frame.is_staged:
+                run.mode = 'publish'
+                ranks = frame.staged_ranks(winners_num, waiting_num)
+            else:
+                run.mode = 'draw'
+                if rng is None:
+                    rng = _lottery_rng(lottery, run)
+                ranks = draw_frame(frame, winners_num, waiting_num,
+                                   group_advantage_calculation, rng, timer)
+            timer.lap('draw')
+            statuses = write_results(frame, ranks, winners_num, waiting_num)
+            winners = frame.user_ids[statuses == WON].tolist()
+            run.applications = len(frame)
+            run.groups = frame.n_groups
+            timer.lap('write')
 
-        rest_winners_num = winners_num - len(won_group_members)
-        won_normal_users = draw_one_normal_users(
-            applications, rest_winners_num,
-            target_status="pending", win_status="won",
-            lose_status="waiting-pending")
+        db.session.add(lottery)
+        db.session.commit()
+        timer.lap('commit')
 
-        winners = [winner_app.user for winner_app in chain(won_group_members,
-                                                           won_normal_users)]
+    run.winners = len(winners)
+    run.queries = len(statements)
+    run.set_timings(timer.seconds, timer.total)
+    db.session.add(run)
+    db.session.commit()
+    return winners
 
-        waiting_group_members = draw_one_group_members(
-            applications, waiting_num, set_just=False,
-            target_status="waiting-pending",
-            win_status="waiting", lose_status="lose")
 
-        rest_waiting_num = waiting_num - len(waiting_group_members)
-        draw_one_normal_users(
-            applications, rest_waiting_num,
-            target_status="waiting-pending",
-            win_status="waiting", lose_status="lose")
+def drawn_winners(lottery):
+    """
+        winners of the lottery if it is already drawn today
+        Args:
+          lottery(Lottery): The lottery to check
+        Return:
+          winners([int]): ids of users who won,
+                          None if there is anything to draw
+    """
+    today = get_current_datetime().date()
+    pending, decided = (
+        db.session.query(
+            func.count(case([(Application.status == 'pending', 1)])),
+            func.count(case([(Application.status != 'pending', 1)])))
+        .filter(Application.lottery_id == lottery.id,
+                Application.created_on == today)
+        .one()
+    )
+    if pending or not decided:
+        return None
+    return [user_id for user_id, in
+            db.session.query(Application.user_id)
+            .filter(Application.lottery_id == lottery.id,
+                    Application.created_on == today,
+                    Application.status == 'won')]
 
-    db.session.add(lottery)
-    db.session.commit()
 
-    return winners
+def _lottery_seed(lottery, run):
+    """internal function
+        the seed of the lottery, recorded in the run
+    """
+    seed = lottery_seed(lottery)
+    run.set_seed(seed.entropy, seed.spawn_key)
+    return seed
 
 
-def draw_one_group_members(applications, winners_num, set_just=True,
-                           **kwargs):
+def _lottery_rng(lottery, run):
     """internal function
-        decide win (waiting) or lose for each group
-    """
-    target_status = \
-        kwargs['target_status'] if 'target_status' in kwargs else "pending"
-    win_status = \
-        kwargs['win_status'] if 'win_status' in kwargs else "won"
-    lose_status = \
-        kwargs['lose_status'] if 'lose_status' in kwargs else "lose"
-
-    target_apps = [app for app in applications if app.status == target_status]
-    winner_apps = []
-    loser_apps = []
-    winner_reps = []
-    loser_reps = []
-
-    def set_group_result(rep, is_won):
-        if is_won:
-            status, to_apps, to_reps = win_status, winner_apps, winner_reps
-        else:
-            status, to_apps, to_reps = lose_status, loser_apps, loser_reps
+        the random stream of the lottery, with its seed recorded in the run
+    """
+    return np.random.Generator(np.random.PCG64(_lottery_seed(lottery, run)))
+
+
+def dry_run_one(lottery, rng=None):
+    """
+        Draw the specified lottery without writing anything,
+        to see the result and how long the draw takes.
+        The Python engine is used whatever DRAW_BACKEND is
+        Args:
+          lottery(Lottery): The lottery to be drawn
+          rng(numpy.random.Generator): source of randomness.
+              the stream of the lottery if None, so that the result is
+              the one `draw_one` will give on the same applications
+              once the root seed of the day is recorded (or set by
+              DRAW_ROOT_SEED). a dry run doesn't record it
+        Return:
+          result(dict): lottery_id, number of applications,
+                        winners([User]), number of waiting applications
+                        and timings (seconds) of each phase
+    """
+    winners_num = current_app.config['WINNERS_NUM']
+    waiting_num = current_app.config['WAITING_NUM']
+    timer = PhaseTimer()
+
+    frame = load_frame(lottery)
+    timer.lap('load')
+    if frame.is_staged:
+        ranks = frame.staged_ranks(winners_num, waiting_num)
+    else:
+        if rng is None:
+            rng = lottery_rng(lottery, record=False)
+        ranks = draw_frame(frame, winners_num, waiting_num,
+                           group_advantage_calculation, rng, timer)
+    statuses = statuses_from_ranks(ranks, winners_num, waiting_num)
+    timer.lap('draw')
+
+    winner_ids = frame.user_ids[statuses == WON].tolist()
+    winners = User.query.filter(User.id.in_(winner_ids)).all() \
+        if winner_ids else []
+    db.session.rollback()
+
+    return {
+        'lottery_id': lottery.id,
+        'applications': len(frame),
+        'winners': winners,
+        'waiting': int((statuses == WAITING).sum()),
+        'timings': dict(timer.seconds, total=timer.total,
+                        draw=timer.sum(*DrawRun.draw_phases)),
+    }
+
+
+def dry_run_all_at_index(index):
+    """
+        Draw all lotteries in the specific index without writing anything
+        Args:
+          index(int): zero-based index that indicates the time of lottery
+        Return:
+          results([dict]): result of `dry_run_one` for each lottery
+    """
+    lotteries = Lottery.query.filter_by(index=index).all()
+    return [dry_run_one(lottery) for lottery in lotteries]
+
+
+def stage_one(lottery, rng=None):
+    """
+        Draw the specified lottery in advance.
+        Only the ranks are recorded and the applications stay pending,
+        so that `draw_one` just has to publish them.
+        A lottery already staged is left as it is.
+        The lottery is locked while it is staged.
+        Timings are recorded as a `DrawRun`
+        Args:
+          lottery(Lottery): The lottery to be staged
+          rng(numpy.random.Generator): source of randomness.
+                                       the stream of the lottery if None
+        Return:
+          staged(bool): whether the lottery was staged by this call
+    """
+    with lottery_lock(lottery):
+        return _stage_one(lottery, rng)
+
 
-        rep.set_status(status)
-        to_apps.append(rep)     # record results
-        to_reps.append(rep)
+def _stage_one(lottery, rng):
+    """internal function
+        stage the lottery holding its lock
+    """
+    run = DrawRun(lottery_id=lottery.id, mode='stage')
+    timer = PhaseTimer()
+
+    with count_queries(db.engine) as statements:
+        frame = load_frame(lottery)
+        timer.lap('load')
+        if len(frame) == 0 or frame.is_staged:
+            db.session.commit()
+            return False
+
+        if rng is None:
+            rng = _lottery_rng(lottery, run)
+        ranks = draw_frame(frame,
+                           current_app.config['WINNERS_NUM'],
+                           current_app.config['WAITING_NUM'],
+                           group_advantage_calculation, rng, timer)
+        timer.lap('draw')
+        write_ranks(frame, ranks)
+        timer.lap('write')
+        db.session.commit()
+        timer.lap('commit')
+
+    run.applications = len(frame)
+    run.groups = frame.n_groups
+    run.queries = len(statements)
+    run.set_timings(timer.seconds, timer.total)
+    db.session.add(run)
+    db.session.commit()
+    return True
 
-        for member in rep.group_members:
-            member.own_application.set_status(status)
-            to_apps.append(member.own_application)
 
-    def unset_group_result(rep, from_apps, from_reps):
-        from_apps.remove(rep)   # remove recorded old results
-        from_reps.remove(rep)
-        for member in rep.group_members:
-            from_apps.remove(member.own_application)
+def is_staged(lottery):
+    """
+        whether every pending application of the lottery has a staged rank
+        Args:
+          lottery(Lottery): The lottery to check
+    """
+    total, ranked = (
+        db.session.query(func.count(Application.id),
+                         func.count(Application.rank))
+        .filter(Application.lottery_id == lottery.id,
+                Application.created_on == get_current_datetime().date(),
+                Application.status == 'pending')
+        .one()
+    )
+    return total > 0 and total == ranked
 
-    reps = [app for app in target_apps if app.is_rep]
 
-    probability_dict = get_probability_dict(target_apps, winners_num)
+class AlreadyPromotedError(Exception):
+    """
+        applications of the lottery are already promoted by `promote_one`
+    """
+    pass
 
-    for i, rep in enumerate(reps):
-        set_group_result(rep,
-                         random.random() < probability_dict[rep])
 
-    n_group_members = sum(len(rep.group_members) + 1
-                          for rep in reps)
-    n_normal_users = len(target_apps) - n_group_members
+def recut_one(lottery, winners_num, waiting_num):
+    """
+        Decide the statuses of the drawn applications again
+        with new numbers, from the ranks recorded by the draw.
+        No new randomness is used.
+        A lottery with promoted applications can't be re-cut,
+        as the ranks don't know about the promotions.
+        The lottery is locked while it is re-cut
+        Args:
+          lottery(Lottery): The lottery already drawn
+          winners_num(int): how many applications win
+          waiting_num(int): how many applications are put on the waiting list
+        Return:
+          winners([User]): The list of users who won
+        Raises:
+          AlreadyPromotedError: applications are already promoted
+    """
+    with lottery_lock(lottery):
+        if is_promoted(lottery):
+            raise AlreadyPromotedError()
+        winners = _recut_one(lottery, winners_num, waiting_num)
+
+    if not winners:
+        return []
+    return User.query.filter(User.id.in_(winners)).all()
+
+
+def _recut_one(lottery, winners_num, waiting_num):
+    """internal function
+        re-cut the lottery holding its lock
+        Return:
+          winners([int]): ids of users who won
+    """
+    rows = (
+        db.session.query(Application.id, Application.user_id,
+                         Application.status, Application.rank)
+        .filter(Application.lottery_id == lottery.id,
+                Application.created_on == get_current_datetime().date(),
+                Application.status != 'pending',
+                Application.rank.isnot(None))
+        .all()
+    )
 
-    def adjust():
-        # when too few groups accidentally won
-        while loser_reps and len(winner_apps) < winners_num - n_normal_users:
-            new_winner = random.choice(loser_reps)
-            unset_group_result(new_winner, loser_apps, loser_reps)
-            set_group_result(new_winner, True)
-        # when too many groups accidentally won
-        while len(winner_apps) > winners_num:
-            new_loser = random.choice(winner_reps)
-            unset_group_result(new_loser, winner_apps, winner_reps)
-            set_group_result(new_loser, False)
+    winners = []
+    if rows:
+        app_ids, user_ids, old_statuses, ranks = zip(*rows)
+        statuses = statuses_from_ranks(ranks, winners_num, waiting_num)
 
-    if not set_just:
-        adjust()
-        for user in chain(winner_apps, loser_apps):
-            db.session.add(user)
+        transitions = StatusTransitions()
+        for app_id, user_id, old_status, status in zip(
+                app_ids, user_ids, old_statuses, statuses.tolist()):
+            transitions.add(app_id, user_id, old_status, STATUS_NAMES[status])
+            if status == WON:
+                winners.append(user_id)
+        transitions.apply()
 
-        return winner_apps
+    db.session.commit()
+    return winners
 
-    while (loser_reps and len(winner_apps) < winners_num - n_normal_users or
-           len(winner_apps) > winners_num):
-        adjust()
 
-    for user in chain(winner_apps, loser_apps):
-        db.session.add(user)
+def promote_one(lottery, count):
+    """
+        Promote applications on the waiting list to winners,
+        in the order of their ranks.
+        A group is promoted only when all its members fit in `count`,
+        and nobody behind it is promoted before it.
+        The lottery is locked while it is promoted, and the promotion
+        is recorded as a `DrawRun`
+        Args:
+          lottery(Lottery): The lottery already drawn
+          count(int): how many seats are available
+        Return:
+          winners([User]): The list of users promoted
+    """
+    with lottery_lock(lottery):
+        promoted = _promote_one(lottery, count)
 
-    return winner_apps
+    if not promoted:
+        return []
+    return User.query.filter(User.id.in_(promoted)).all()
 
 
-def draw_one_normal_users(applications, winners_num, **kwargs):
+def _promote_one(lottery, count):
     """internal function
-        decide win or lose for each user not belonging to a group
-        add applications to the session
-    """
-    target_status = \
-        kwargs['target_status'] if 'target_status' in kwargs else "pending"
-    win_status = \
-        kwargs['win_status'] if 'win_status' in kwargs else "won"
-    lose_status = \
-        kwargs['lose_status'] if 'lose_status' in kwargs else "lose"
-
-    normal_users = [app for app in applications if app.status == target_status]
-
-    if len(normal_users) <= winners_num or not normal_users:
-        # if pending applications are less than winners_num,
-        # all applications win
-        winner_apps = normal_users
-    else:
-        winner_apps = choice(
-            normal_users, winners_num,
-            replace=False,      # no duplication
-            p=calc_probabilities(normal_users))
+        promote applications holding the lock of the lottery
+        Return:
+          promoted([int]): ids of users promoted
+    """
+    run = DrawRun(lottery_id=lottery.id, mode='promote')
+    timer = PhaseTimer()
+
+    with count_queries(db.engine) as statements:
+        # one more row tells whether the last group is cut by `count`
+        rows = (
+            db.session.query(Application.id, Application.user_id,
+                             Application.rank)
+            .filter(Application.lottery_id == lottery.id,
+                    Application.created_on == get_current_datetime().date(),
+                    Application.status == 'waiting')
+            .order_by(Application.rank, Application.id)
+            .limit(count + 1)
+            .with_for_update()
+            .all()
+        )
+        timer.lap('load')
+        promoted = rows[:count]
+        if len(rows) > count:
+            last_rank = rows[count].rank
+            promoted = [row for row in promoted if row.rank != last_rank]
+
+        transitions = StatusTransitions()
+        for app_id, user_id, _ in promoted:
+            transitions.add(app_id, user_id, 'waiting', 'won')
+        transitions.apply()
+        timer.lap('write')
+        db.session.commit()
+        timer.lap('commit')
+
+    if promoted:
+        run.winners = len(promoted)
+        run.queries = len(statements)
+        run.set_timings(timer.seconds, timer.total)
+        db.session.add(run)
+        db.session.commit()
+    return [user_id for _, user_id, _ in promoted]
+
+
+def is_promoted(lottery):
+    """
+        whether applications of the lottery are promoted today
+        Args:
+          lottery(Lottery): The lottery to check
+    """
+    today = get_current_datetime().replace(hour=0, minute=0, second=0,
+                                           microsecond=0)
+    return db.session.query(
+        DrawRun.query.filter(DrawRun.lottery_id == lottery.id,
+                             DrawRun.mode == 'promote',
+                             DrawRun.created_at >= today)
+        .exists()).scalar()
 
-    for application in normal_users:
-        application.set_status(win_status if application in winner_apps
-                               else lose_status)
-        db.session.add(application)
 
-    return winner_apps
+def use_sql_backend():
+    """
+        whether lotteries are drawn inside the database.
+        DRAW_BACKEND == 'sql' is honored only on PostgreSQL
+    """
+    if current_app.config['DRAW_BACKEND'] != 'sql':
+        return False
+    if not draw_sql.is_available():
+        current_app.logger.warning(
+            'DRAW_BACKEND == sql needs PostgreSQL. '
+            'Drawing with the Python engine instead.')
+        return False
+    return True
 
 
 def draw_all_at_index(index):
     """
         Draw all lotteries in the specific index
+        Lotteries are drawn in DRAW_PARALLELISM threads at the same time,
+        each with its own DB session and the random stream of the lottery
         Args:
           index(int): zero-based index that indicates the time of lottery
         Return:
           winners([[User]]): The list of list of users who won
     """
-    lotteries = Lottery.query.filter_by(index=index)
+    lotteries = Lottery.query.filter_by(index=index).all()
+    get_root_entropy()  # record the root seed before workers need it
 
-    winners = [draw_one(lottery)
-               for lottery in lotteries]
+    parallelism = current_app.config['DRAW_PARALLELISM']
+    if parallelism > 1 and len(lotteries) > 1 and _can_draw_in_parallel():
+        winners = _draw_in_parallel(lotteries, parallelism)
+    else:
+        winners = [draw_one(lottery) for lottery in lotteries]
 
     for lottery in lotteries:
         db.session.add(lottery)
@@ -209,35 +488,36 @@ def draw_all_at_index(index):
     return winners
 
 
-def calc_probabilities(applications):
-    """
-        calculate the probability of each application
-        return list of the weight of each application showing how likely
-        the application is to be chosen in comparison with others
-        *the sum of the list is 1*
+def _can_draw_in_parallel():
+    """internal function
+        in-memory SQLite shares one connection among all threads,
+        so that lotteries can't be drawn in separate transactions
     """
-    sum_advantage = sum(app.get_advantage() for app in applications)
-    return [app.get_advantage() / sum_advantage for app in applications]
+    url = db.engine.url
+    return not (url.get_backend_name() == 'sqlite' and
+                url.database in (None, '', ':memory:'))
 
 
-def get_probability_dict(applications, winners_num):
-    all_probabilities = calc_probabilities(applications)
-    return {app: all_probabilities[i] * winners_num
-            for i, app in enumerate(applications)}
-
-
-def set_group_advantage(apps):
-    """
-        calculate the advantage of the group using group_advantage_calculation
+def _draw_in_parallel(lotteries, parallelism):
+    """internal function
+        draw each lottery in a worker thread and merge the winners
     """
-    def group_apps(rep):
-        members = [member.own_application for member in rep.group_members]
-        members.append(rep)
-        return members
-
-    reps = (app for app in apps if app.is_rep)
-    groups = (group_apps(rep) for rep in reps)
-    for group in groups:
-        advantage = group_advantage_calculation(group)
-        for app in group:
-            app.set_advantage(advantage)
+    app = current_app._get_current_object()
+
+    def draw_in_worker(lottery_id):
+        with app.app_context():
+            try:
+                winners = draw_one(Lottery.query.get(lottery_id))
+                return [winner.id for winner in winners]
+            finally:
+                db.session.remove()
+
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        winner_ids = list(executor.map(
+            draw_in_worker, [lottery.id for lottery in lotteries]))
+
+    all_ids = [user_id for ids in winner_ids for user_id in ids]
+    users = {user.id: user
+             for user in User.query.filter(User.id.in_(all_ids))} \
+        if all_ids else {}
+    return [[users[user_id] for user_id in ids] for ids in winner_ids]
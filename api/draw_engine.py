@@ -0,0 +1,488 @@
+import numpy as np
+from api.models import Application, GroupMember, StatusTransitions, db
+from api.time_management import get_current_datetime
+
+__docs__ = """vectorized draw engine
+
+    A lottery is drawn on a `DrawFrame`, which holds the pending
+    applications of the lottery as NumPy arrays. Statuses are computed
+    in memory and written back in one go, so the ORM objects of each
+    application are never touched during the draw.
+"""
+
+# status codes used inside the engine
+PENDING, WON, WAITING, LOSE = range(4)
+STATUS_NAMES = ('pending', 'won', 'waiting', 'lose')
+
+
+def calc_advantages(win_count, lose_count, waiting_count, base=3.0):
+    """
+        vectorized version of `api.models.calc_advantage`
+        Args:
+          win_count(numpy.ndarray): how many times each user won
+          lose_count(numpy.ndarray): how many times each user lost
+          waiting_count(numpy.ndarray): how many times each user waited
+          base(float): growth of the advantage per lose.
+                       other values are for simulations only
+        Return:
+          advantages(numpy.ndarray): multiplier indicating how more likely
+                                     each application is to win
+    """
+    win_count = np.asarray(win_count, dtype=float)
+    lose_count = np.asarray(lose_count, dtype=float)
+    waiting_count = np.asarray(waiting_count, dtype=float)
+    exponent = np.maximum(0, lose_count + waiting_count / 2 - win_count)
+    return np.where(lose_count == 0, 1.0, base ** exponent)
+
+
+def calc_probabilities(advantages):
+    """
+        calculate the probability of each application
+        return array of the weight of each application showing how likely
+        the application is to be chosen in comparison with others
+        *the sum of the array is 1*
+    """
+    advantages = np.asarray(advantages, dtype=float)
+    return advantages / advantages.sum()
+
+
+class GroupAdvantage:
+    """
+        policies to decide the advantage shared by the members of a group
+        Args:
+          advantages(numpy.ndarray): advantage of each application in groups
+          groups(numpy.ndarray): group number (0, 1, ...) of each application
+          is_rep(numpy.ndarray): whether each application is the rep
+        Return:
+          advantages(numpy.ndarray): the advantage of each group
+    """
+    @staticmethod
+    def minimum(advantages, groups, is_rep):
+        result = np.full(_count_groups(groups), np.inf)
+        np.minimum.at(result, groups, advantages)
+        return result
+
+    @staticmethod
+    def average(advantages, groups, is_rep):
+        n_groups = _count_groups(groups)
+        return (np.bincount(groups, advantages, minlength=n_groups) /
+                np.bincount(groups, minlength=n_groups))
+
+    @staticmethod
+    def rep(advantages, groups, is_rep):
+        result = np.ones(_count_groups(groups))
+        result[groups[is_rep]] = advantages[is_rep]
+        return result
+
+
+def _count_groups(groups):
+    return int(groups.max()) + 1 if len(groups) else 0
+
+
+class DrawFrame:
+    """
+        pending applications of one lottery as arrays
+        Args:
+          application_ids(numpy.ndarray): id of each application
+          user_ids(numpy.ndarray): id of the applicant
+          is_rep(numpy.ndarray): whether the application is a group rep
+          groups(numpy.ndarray): group number of the application,
+                                 -1 when it does not belong to a group
+          advantages(numpy.ndarray): advantage recorded on the application
+          ranks(numpy.ndarray): rank staged by the pre-draw, 0 when not staged
+          rep_advantages(numpy.ndarray): group advantage recorded on reps,
+                                         NaN when it is not recorded
+    """
+    def __init__(self, application_ids, user_ids, is_rep, groups, advantages,
+                 ranks=None, rep_advantages=None):
+        self.application_ids = np.asarray(application_ids, dtype=int)
+        self.user_ids = np.asarray(user_ids, dtype=int)
+        self.is_rep = np.asarray(is_rep, dtype=bool)
+        self.groups = np.asarray(groups, dtype=int)
+        self.advantages = np.asarray(advantages, dtype=float)
+        self.ranks = np.zeros(len(self.application_ids), dtype=int) \
+            if ranks is None else np.asarray(ranks, dtype=int)
+        self.rep_advantages = np.full(len(self.application_ids), np.nan) \
+            if rep_advantages is None \
+            else np.asarray(rep_advantages, dtype=float)
+
+    def __len__(self):
+        return len(self.application_ids)
+
+    @property
+    def is_staged(self):
+        """
+            whether every application has the rank staged by the pre-draw
+        """
+        return len(self) > 0 and bool((self.ranks > 0).all())
+
+    def staged_ranks(self, winners_num, waiting_num):
+        """
+            the staged ranks with the seats of cancelled applications
+            filled, keeping the staged order.
+            as `promote_one` does, the next groups on the waiting list
+            (then the next losers) move up while they fit in the seats
+            Args:
+              winners_num(int): how many applications win
+              waiting_num(int): how many applications are put
+                                on the waiting list
+        """
+        unit_ranks, unit_of = np.unique(self.ranks, return_inverse=True)
+        sizes = np.bincount(unit_of)
+        statuses = statuses_from_ranks(unit_ranks, winners_num, waiting_num)
+        for upper, lower, seats in ((WON, WAITING, winners_num),
+                                    (WAITING, LOSE, waiting_num)):
+            free = seats - sizes[statuses == upper].sum()
+            for unit in np.flatnonzero(statuses == lower).tolist():
+                if sizes[unit] > free:
+                    break
+                statuses[unit] = upper
+                free -= sizes[unit]
+        ends = _band_ranks(statuses, sizes, np.arange(len(sizes)),
+                           winners_num, waiting_num)
+        return ends[unit_of]
+
+    @property
+    def n_groups(self):
+        return _count_groups(self.groups[self.groups >= 0])
+
+    def group_advantages(self, calculation):
+        """
+            advantage of each application with the advantage of groups
+            replaced by the value recorded on the rep,
+            or by the value of `calculation` if it is not recorded
+        """
+        advantages = self.advantages.copy()
+        in_group = self.groups >= 0
+        if in_group.any():
+            groups = self.groups[in_group]
+            shared = calculation(advantages[in_group], groups,
+                                 self.is_rep[in_group])
+            recorded = self.rep_advantages[in_group]
+            known = ~np.isnan(recorded)
+            shared[groups[known]] = recorded[known]
+            advantages[in_group] = shared[groups]
+        return advantages
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+            construct from rows of
+            (application_id, user_id, is_rep, rep_application_id,
+             advantage, group_advantage, rank)
+        """
+        (application_ids, user_ids, is_rep, rep_ids,
+         advantages, rep_advantages, ranks) = zip(*rows) if rows else ([],) * 7
+        group_keys = np.array(
+            [rep_id if rep_id is not None else (app_id if rep else -1)
+             for app_id, rep, rep_id
+             in zip(application_ids, is_rep, rep_ids)], dtype=int)
+        groups = np.full(len(group_keys), -1)
+        in_group = group_keys >= 0
+        groups[in_group] = np.unique(group_keys[in_group],
+                                     return_inverse=True)[1]
+        return cls(application_ids, user_ids, [bool(r) for r in is_rep],
+                   groups, advantages, [rank or 0 for rank in ranks],
+                   [np.nan if value is None else value
+                    for value in rep_advantages])
+
+
+def load_frame(lottery):
+    """
+        load today's pending applications of the lottery with one query
+        Args:
+          lottery(Lottery): the lottery to be drawn
+        Return:
+          frame(DrawFrame): the loaded applications
+    """
+    rows = (
+        db.session.query(Application.id, Application.user_id,
+                         Application.is_rep,
+                         GroupMember.rep_application_id,
+                         Application.advantage, Application.group_advantage,
+                         Application.rank)
+        .outerjoin(GroupMember,
+                   GroupMember.own_application_id == Application.id)
+        .filter(Application.lottery_id == lottery.id,
+                Application.created_on == get_current_datetime().date(),
+                Application.status == "pending")
+        .order_by(Application.id)
+        .all()
+    )
+    return DrawFrame.from_rows(rows)
+
+
+def draw_frame(frame, winners_num, waiting_num, group_advantage, rng,
+               timer=None):
+    """
+        draw the applications in the frame and rank them.
+        winners come first, then the waiting list, then the others,
+        and members of a group are kept together. seats left by groups
+        which didn't fit are left as gaps in the ranks, so that
+        `statuses_from_ranks` with the same numbers gives the result
+        Args:
+          frame(DrawFrame): the applications to be drawn
+          winners_num(int): how many applications win
+          waiting_num(int): how many applications are put on the waiting list
+          group_advantage(function): one of `GroupAdvantage` policies
+          rng(numpy.random.Generator): source of randomness
+          timer(api.utils.PhaseTimer): timer to record the phases
+              'advantage', 'sample' and 'rank' in, if given
+        Return:
+          ranks(numpy.ndarray): rank of each application
+    """
+    advantages = frame.group_advantages(group_advantage)
+    if timer is not None:
+        timer.lap('advantage')
+    statuses = np.full(len(frame), PENDING)
+
+    won = _draw_phase(frame, advantages, statuses == PENDING,
+                      winners_num, rng)
+    statuses[won] = WON
+
+    rest = statuses == PENDING
+    waiting = _draw_phase(frame, advantages, rest, waiting_num, rng)
+    statuses[rest] = LOSE
+    statuses[waiting] = WAITING
+    if timer is not None:
+        timer.lap('sample')
+
+    ranks = _rank(frame, advantages, statuses, winners_num, waiting_num, rng)
+    if timer is not None:
+        timer.lap('rank')
+    return ranks
+
+
+def statuses_from_ranks(ranks, winners_num, waiting_num):
+    """
+        cut ranks into statuses
+        Args:
+          ranks(numpy.ndarray): rank of each application
+          winners_num(int): how many applications win
+          waiting_num(int): how many applications are put on the waiting list
+        Return:
+          statuses(numpy.ndarray): status code of each application
+    """
+    ranks = np.asarray(ranks)
+    return np.select([ranks <= winners_num,
+                      ranks <= winners_num + waiting_num],
+                     [WON, WAITING], LOSE)
+
+
+def _rank(frame, advantages, statuses, winners_num, waiting_num, rng):
+    """internal function
+        order groups and users not belonging to a group by status, then by
+        weighted random keys. the rank of an application is the position
+        of the last member of its group in the order (1-based), counted
+        from the first seat of its status (see `_band_ranks`)
+    """
+    if len(frame) == 0:
+        return np.zeros(0, dtype=int)
+
+    units = np.where(frame.groups >= 0, frame.groups,
+                     frame.n_groups + np.arange(len(frame)))
+    _, first, unit_of = np.unique(units, return_index=True,
+                                  return_inverse=True)
+    sizes = np.bincount(unit_of)
+    keys = priority_keys(advantages[first], rng)
+    order = np.lexsort((-keys, statuses[first]))
+
+    ends = _band_ranks(statuses[first], sizes, order,
+                       winners_num, waiting_num)
+    return ends[unit_of]
+
+
+def _band_ranks(statuses, sizes, order, winners_num, waiting_num):
+    """internal function
+        end position of each unit (a group or a user) in `order`,
+        where winners are counted from 1, the waiting list from
+        winners_num + 1 and the others from winners_num + waiting_num + 1,
+        so that seats not filled stay empty when the ranks are cut
+        Args:
+          statuses(numpy.ndarray): status of each unit
+          sizes(numpy.ndarray): number of applications in each unit
+          order(numpy.ndarray): indices of units in the order of ranks
+    """
+    ends = np.empty(len(sizes), dtype=int)
+    for status, offset in ((WON, 0), (WAITING, winners_num),
+                           (LOSE, winners_num + waiting_num)):
+        band = order[statuses[order] == status]
+        ends[band] = offset + np.cumsum(sizes[band])
+    return ends
+
+
+def _draw_phase(frame, advantages, target, winners_num, rng):
+    """internal function
+        choose `winners_num` applications from `target`.
+        groups are decided first, then users not belonging to a group
+        fill the rest
+    """
+    chosen = np.zeros(len(frame), dtype=bool)
+    if winners_num <= 0 or not target.any():
+        return chosen
+
+    reps = np.flatnonzero(target & frame.is_rep)
+    rep_groups = frame.groups[reps]
+    in_group = target & (frame.groups >= 0)
+    sizes = np.bincount(frame.groups[in_group],
+                        minlength=frame.n_groups)[rep_groups]
+    normals = np.flatnonzero(target & (frame.groups < 0))
+
+    probabilities = \
+        advantages[reps] / advantages[target].sum() * winners_num
+    won_groups = sample_groups(probabilities, sizes,
+                               winners_num - len(normals), winners_num, rng)
+    chosen[in_group & np.isin(frame.groups, rep_groups[won_groups])] = True
+
+    rest_winners_num = winners_num - sizes[won_groups].sum()
+    if len(normals) <= rest_winners_num:
+        # if pending applications are less than winners_num,
+        # all applications win
+        chosen[normals] = True
+    else:
+        chosen[normals[weighted_sample(advantages[normals],
+                                       rest_winners_num, rng)]] = True
+
+    return chosen
+
+
+def priority_keys(weights, rng):
+    """
+        random keys of Efraimidis-Spirakis weighted sampling.
+        sorting by the key in descending order gives a weighted random
+        permutation, in which items with larger weight tend to come first
+        Args:
+          weights(numpy.ndarray): positive weight of each item,
+                                  in any shape
+          rng(numpy.random.Generator): source of randomness
+        Return:
+          keys(numpy.ndarray): log(u) / weight for uniform u of each item
+    """
+    weights = np.asarray(weights, dtype=float)
+    with np.errstate(divide='ignore'):
+        return np.log(rng.random(weights.shape)) / weights
+
+
+def weighted_sample(weights, k, rng):
+    """
+        weighted random sampling of `k` items without replacement
+        in O(n + k log k)
+        Args:
+          weights(numpy.ndarray): positive weight of each item
+          k(int): number of items to choose
+          rng(numpy.random.Generator): source of randomness
+        Return:
+          indices(numpy.ndarray): indices of chosen items,
+                                  in the order they were drawn
+    """
+    n = len(weights)
+    k = min(max(k, 0), n)
+    if k == 0:
+        return np.zeros(0, dtype=int)
+    keys = priority_keys(weights, rng)
+    if k < n:
+        top = np.argpartition(-keys, k - 1)[:k]
+    else:
+        top = np.arange(n)
+    return top[np.argsort(-keys[top], kind='stable')]
+
+
+def sample_groups(probabilities, sizes, lower, upper, rng):
+    """
+        choose the groups to win in one bounded pass.
+        each group first wins with its probability, then the result is
+        repaired so that the chosen groups hold between `lower` and `upper`
+        applications (or as many as possible up to `upper`).
+        groups are repaired in weighted random order: groups that lost are
+        added most likely first, groups that won are removed least likely
+        first.
+        Args:
+          probabilities(numpy.ndarray): probability of each group to win
+          sizes(numpy.ndarray): number of applications in each group
+          lower(int): minimum number of applications in chosen groups
+          upper(int): maximum number of applications in chosen groups
+          rng(numpy.random.Generator): source of randomness
+        Return:
+          won(numpy.ndarray): whether each group won
+    """
+    n = len(sizes)
+    won = np.zeros(n, dtype=bool)
+    if n == 0 or upper <= 0:
+        return won
+
+    wanted = rng.random(n) < probabilities
+    keys = priority_keys(probabilities, rng)
+    # groups won the coin toss first, then the others, likely ones first
+    order = np.lexsort((-keys, ~wanted))
+    ordered_sizes = sizes[order].tolist()
+
+    # reachable[i]: bitset of totals made of groups in order[i:]
+    limit = (1 << (upper + 1)) - 1
+    reachable = [1] * (n + 1)
+    for i in range(n - 1, -1, -1):
+        rest = reachable[i + 1]
+        reachable[i] = (rest | (rest << ordered_sizes[i])) & limit
+
+    if not _reaches(reachable[0], lower, upper):
+        # fill as many as possible if the range can't be reached
+        lower = reachable[0].bit_length() - 1
+
+    total = 0
+    for i, (group, size) in enumerate(zip(order.tolist(), ordered_sizes)):
+        rest = reachable[i + 1]
+        can_include = _reaches(rest, lower - total - size,
+                               upper - total - size)
+        can_exclude = _reaches(rest, lower - total, upper - total)
+        if (wanted[group] and can_include) or not can_exclude:
+            won[group] = True
+            total += size
+
+    return won
+
+
+def _reaches(reachable, lower, upper):
+    """internal function
+        whether the bitset of totals has a total in [lower, upper]
+    """
+    lower = max(lower, 0)
+    if upper < lower:
+        return False
+    return bool((reachable >> lower) & ((1 << (upper - lower + 1)) - 1))
+
+
+def write_ranks(frame, ranks):
+    """
+        write ranks into the current transaction
+        Args:
+          frame(DrawFrame): the drawn applications
+          ranks(numpy.ndarray): rank of each application
+    """
+    db.session.bulk_update_mappings(Application, [
+        {'id': app_id, 'rank': rank}
+        for app_id, rank
+        in zip(frame.application_ids.tolist(), ranks.tolist())
+    ])
+
+
+def write_results(frame, ranks, winners_num, waiting_num):
+    """
+        write ranks and statuses cut from them into the current transaction
+        Args:
+          frame(DrawFrame): the drawn applications
+          ranks(numpy.ndarray): rank of each application
+          winners_num(int): how many applications win
+          waiting_num(int): how many applications are put on the waiting list
+        Return:
+          statuses(numpy.ndarray): status code of each application
+    """
+    statuses = statuses_from_ranks(ranks, winners_num, waiting_num)
+    write_ranks(frame, ranks)
+
+    transitions = StatusTransitions()
+    for app_id, user_id, status in zip(frame.application_ids.tolist(),
+                                       frame.user_ids.tolist(),
+                                       statuses.tolist()):
+        transitions.add(app_id, user_id, "pending", STATUS_NAMES[status])
+    transitions.apply()
+
+    return statuses
@@ -0,0 +1,89 @@
+from contextlib import contextmanager
+import fcntl
+import os
+import threading
+from sqlalchemy import text
+from api.models import db
+
+__docs__ = """per-lottery lock of draws
+
+    A lottery is drawn by at most one worker at a time, whichever process
+    or thread it runs in. On PostgreSQL the lock is a session-level
+    advisory lock held on a connection of its own, so that it survives
+    the commits of the draw. On SQLite it is an exclusive `flock` on a
+    file next to the database, or a lock in the process for an in-memory
+    database, which can't be shared with other processes anyway.
+"""
+
+# first key of pg_advisory_lock(int, int), to keep clear of other locks
+ADVISORY_LOCK_NAMESPACE = 1
+
+_memory_locks = {}
+_memory_locks_guard = threading.Lock()
+
+
+@contextmanager
+def lottery_lock(lottery):
+    """
+        hold the lock of the lottery inside the block.
+        blocks until the worker holding it releases it
+        Args:
+          lottery(Lottery): the lottery to lock
+    """
+    url = db.engine.url
+    if url.get_backend_name() == 'postgresql':
+        lock = _advisory_lock(lottery.id)
+    elif url.database in (None, '', ':memory:'):
+        lock = _memory_lock(lottery.id)
+    else:
+        lock = _file_lock(f'{url.database}-lottery-{lottery.id}.lock')
+    with lock:
+        yield
+
+
+@contextmanager
+def _advisory_lock(key):
+    """internal function
+        session-level advisory lock of PostgreSQL
+    """
+    connection = db.engine.connect()
+    try:
+        connection.execute(text('SELECT pg_advisory_lock(:namespace, :key)'),
+                           namespace=ADVISORY_LOCK_NAMESPACE, key=key)
+        try:
+            yield
+        finally:
+            connection.execute(
+                text('SELECT pg_advisory_unlock(:namespace, :key)'),
+                namespace=ADVISORY_LOCK_NAMESPACE, key=key)
+    finally:
+        connection.close()
+
+
+@contextmanager
+def _file_lock(path):
+    """internal function
+        exclusive flock on the file, created if missing.
+        the file is left after the release, as removing it would let
+        two workers lock different files of the same path
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def _memory_lock(key):
+    """internal function
+        lock shared by the threads of this process
+    """
+    with _memory_locks_guard:
+        lock = _memory_locks.setdefault(key, threading.Lock())
+    with lock:
+        yield
@@ -0,0 +1,83 @@
+import numpy as np
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from api.models import DrawSeed, db
+from api.time_management import get_current_datetime
+
+__docs__ = """random streams of draws
+
+    Each lottery is drawn with its own `numpy.random.Generator` (PCG64),
+    spawned from the root seed of the festival day with the id of the
+    lottery as the spawn key. The stream of a lottery does not depend on
+    which other lotteries are drawn, in which order or in which process,
+    so that serial, parallel and pre-drawn results are the same and
+    can be reproduced from the recorded root seed.
+
+    The root seed is DRAW_ROOT_SEED combined with the date if it is set,
+    otherwise a random one recorded in the `draw_seed` table.
+"""
+
+
+def get_root_entropy(date=None, record=True):
+    """
+        entropy of the root seed of the day
+        Args:
+          date(datetime.date): the festival day. today if None
+          record(bool): record a new seed when there is none.
+                        if False, nothing is written and a seed not
+                        recorded yet is made for this call only
+        Return:
+          entropy(int|[int]): entropy for `numpy.random.SeedSequence`
+    """
+    if date is None:
+        date = get_current_datetime().date()
+
+    root_seed = current_app.config['DRAW_ROOT_SEED']
+    if root_seed is not None:
+        return [int(root_seed), date.toordinal()]
+
+    seed = DrawSeed.query.filter_by(date=date).first()
+    if seed is not None:
+        return int(seed.entropy)
+
+    entropy = np.random.SeedSequence().entropy
+    if not record:
+        return entropy
+    db.session.add(DrawSeed(date=date, entropy=str(entropy)))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # recorded by another worker at the same time
+        db.session.rollback()
+        entropy = int(DrawSeed.query.filter_by(date=date).one().entropy)
+    return entropy
+
+
+def lottery_seed(lottery, date=None, record=True):
+    """
+        seed of the stream of the lottery
+        Args:
+          lottery(Lottery): the lottery to be drawn
+          date(datetime.date): the festival day. today if None
+          record(bool): record the root seed if it is not yet,
+                        see `get_root_entropy`
+        Return:
+          seed(numpy.random.SeedSequence): the seed
+    """
+    return np.random.SeedSequence(get_root_entropy(date, record),
+                                  spawn_key=(lottery.id,))
+
+
+def lottery_rng(lottery, date=None, record=True):
+    """
+        random stream of the lottery
+        Args:
+          lottery(Lottery): the lottery to be drawn
+          date(datetime.date): the festival day. today if None
+          record(bool): record the root seed if it is not yet,
+                        see `get_root_entropy`
+        Return:
+          rng(numpy.random.Generator): PCG64 generator
+    """
+    return np.random.Generator(np.random.PCG64(
+        lottery_seed(lottery, date, record)))
@@ -0,0 +1,145 @@
+import numpy as np
+from sqlalchemy import text
+from api.models import db
+from api.draw_engine import GroupAdvantage
+from api.time_management import get_current_datetime
+
+__docs__ = """server-side draw for PostgreSQL
+
+    The whole draw of a lottery runs as one SQL statement, so that no
+    application row is sent to the application server.
+
+    Each group (or each user not belonging to a group) gets a weighted
+    random key ln(u) / advantage (Efraimidis-Spirakis), with the advantage
+    recorded on the applications when they were made, and they are
+    ordered by the key. The running total of applications along the
+    order is compared with WINNERS_NUM and WINNERS_NUM + WAITING_NUM,
+    so that a group crossing a threshold falls to the next status as a
+    whole. The running total is recorded as the rank of each application.
+
+    random() is seeded with `setseed` from the stream of the lottery
+    (`api.draw_rng.lottery_seed`) in the same transaction, and the keys
+    are drawn in the order of units, so that the draw can be reproduced
+    from the seed recorded in `DrawRun`. The keys are not the ones the
+    Python engine draws from the same seed.
+
+    Unlike the Python engine, groups are not given the priority
+    to fill the seats before users not belonging to a group, and
+    the seats left by a group crossing a threshold are not given to
+    the units behind it: fewer than WINNERS_NUM applications may win
+    even when there are enough applications to fill the seats.
+"""
+
+# aggregate of `advantage` in `pending` for each group
+GROUP_ADVANTAGE_SQL = {
+    GroupAdvantage.minimum: 'min(advantage)',
+    GroupAdvantage.average: 'avg(advantage)',
+    GroupAdvantage.rep: 'coalesce(max(CASE WHEN is_rep THEN advantage END),'
+                        ' max(advantage))',
+}
+
+DRAW_SQL = """
+WITH pending AS (
+    SELECT a.id, a.user_id, a.is_rep,
+           coalesce(gm.rep_application_id,
+                    CASE WHEN a.is_rep THEN a.id ELSE -a.id END) AS unit,
+           a.advantage, a.group_advantage
+    FROM application a
+    LEFT JOIN group_members gm ON gm.own_application_id = a.id
+    WHERE a.lottery_id = :lottery_id
+      AND a.created_on = :today
+      AND a.status = 'pending'
+    FOR UPDATE OF a
+), units AS (
+    SELECT unit, count(*) AS size,
+           coalesce(max(group_advantage), {group_advantage}) AS advantage
+    FROM pending
+    GROUP BY unit
+), keyed AS (
+    -- the sorted subquery fixes the order random() is called in
+    SELECT unit, size, ln(1.0 - random()) / advantage AS key
+    FROM (SELECT * FROM units ORDER BY unit) sorted_units
+), ordered AS (
+    SELECT unit,
+           sum(size) OVER (ORDER BY key DESC, unit
+                           ROWS UNBOUNDED PRECEDING) AS rank
+    FROM keyed
+), decided AS (
+    SELECT p.id, o.rank,
+           CASE WHEN o.rank <= :winners_num THEN 'won'
+                WHEN o.rank <= :winners_num + :waiting_num THEN 'waiting'
+                ELSE 'lose'
+           END AS status
+    FROM pending p
+    JOIN ordered o ON o.unit = p.unit
+), updated AS (
+    UPDATE application a
+    SET status = d.status, rank = d.rank
+    FROM decided d
+    WHERE a.id = d.id
+    RETURNING a.user_id, a.status
+), counts AS (
+    SELECT user_id,
+           count(*) FILTER (WHERE status = 'won') AS won,
+           count(*) FILTER (WHERE status = 'lose') AS lose,
+           count(*) FILTER (WHERE status = 'waiting') AS waiting
+    FROM updated
+    GROUP BY user_id
+)
+UPDATE "user" u
+SET win_count = u.win_count + c.won,
+    lose_count = u.lose_count + c.lose,
+    waiting_count = u.waiting_count + c.waiting,
+    advantage = CASE WHEN u.lose_count + c.lose = 0 THEN 1.0
+                     ELSE power(3.0, greatest(0, u.lose_count + c.lose
+                                                 + (u.waiting_count
+                                                    + c.waiting) / 2.0
+                                                 - u.win_count - c.won))
+                END
+FROM counts c
+WHERE u.id = c.user_id
+RETURNING u.id, c.won
+"""
+
+
+def is_available():
+    """
+        whether the server-side draw can run on the current database
+    """
+    return db.engine.dialect.name == 'postgresql'
+
+
+def setseed_value(seed):
+    """
+        argument of `setseed` in [-1, 1) derived from the seed
+        Args:
+          seed(numpy.random.SeedSequence): seed of the lottery
+    """
+    state = int(seed.generate_state(1, np.uint32)[0])
+    return state / 2 ** 31 - 1
+
+
+def draw_one_sql(lottery, winners_num, waiting_num, group_advantage, seed):
+    """
+        Draw the specified lottery inside the database
+        Args:
+          lottery(Lottery): The lottery to be drawn
+          winners_num(int): how many applications win
+          waiting_num(int): how many applications are put on the waiting list
+          group_advantage(function): one of `GroupAdvantage` policies
+          seed(numpy.random.SeedSequence): seed of the lottery,
+                                           given to `setseed`
+        Return:
+          user_ids([int]): ids of users who won
+    """
+    db.session.execute(text('SELECT setseed(:seed)'),
+                       {'seed': setseed_value(seed)})
+    statement = text(DRAW_SQL.format(
+        group_advantage=GROUP_ADVANTAGE_SQL[group_advantage]))
+    rows = db.session.execute(statement, {
+        'lottery_id': lottery.id,
+        'today': get_current_datetime().date(),
+        'winners_num': winners_num,
+        'waiting_num': waiting_num,
+    }).fetchall()
+    return [user_id for user_id, won in rows if won]
@@ -0,0 +1,137 @@
+from collections import defaultdict
+import json
+from flask import current_app
+from cards.id import encode_public_id
+from api.catalog import find_classroom
+from api.models import Application, Lottery, User, db
+from api.time_management import get_current_datetime, mod_time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+__docs__ = """fast path of JSON responses of the hot list endpoints
+
+    /classrooms, /lotteries and /applications are serialized by the
+    plain functions below instead of marshmallow, with classrooms taken
+    from `api.catalog`, and encoded straight to bytes with orjson when it
+    is installed (json of the standard library otherwise). The output is
+    the same as `classrooms_schema`, `lotteries_schema` and
+    `applications_schema`, which stay the reference: a field added to a
+    schema has to be added here too.
+"""
+
+
+def dumps(obj):
+    """
+        encode the object into JSON bytes, with sorted keys as `jsonify`
+        Args:
+          obj: the object made of dict, list, str, int, float, bool and None
+        Return:
+          data(bytes): UTF-8 JSON
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(obj, sort_keys=True, separators=(',', ':'),
+                      ensure_ascii=False).encode('utf-8')
+
+
+def json_response(obj, status=200):
+    """
+        response of the JSON-encoded object, as `jsonify` makes
+        Args:
+          obj: the object to encode with `dumps`
+          status(int): HTTP status code
+    """
+    return current_app.response_class(
+        dumps(obj), status=status,
+        mimetype=current_app.config['JSONIFY_MIMETYPE'])
+
+
+def classrooms_to_list(classrooms):
+    """
+        same as `classrooms_schema.dump` of the classrooms
+        Args:
+          classrooms([ClassroomEntry]): classrooms in the catalog
+    """
+    return [dict(classroom._asdict()) for classroom in classrooms]
+
+
+def _prefetch_winners(lotteries):
+    """internal function
+        encoded public ids of today's winners of the lotteries, in one query
+        Args:
+          lotteries([Lottery]): lotteries to serialize
+        Return:
+          winners({int: [str]}): winners by lottery id
+    """
+    winners = defaultdict(list)
+    if not lotteries:
+        return winners
+    rows = (db.session.query(Application.lottery_id, User.public_id)
+            .join(User, Application.user_id == User.id)
+            .filter(Application.lottery_id.in_(
+                        [lottery.id for lottery in lotteries]),
+                    Application.created_on == get_current_datetime().date(),
+                    Application.status == "won")
+            .order_by(Application.id))
+    for lottery_id, public_id in rows:
+        winners[lottery_id].append(encode_public_id(public_id))
+    return winners
+
+
+def lotteries_to_list(lotteries):
+    """
+        same as `lotteries_schema.dump(lotteries)[0]`,
+        with classrooms from the catalog and winners fetched in one query
+        Args:
+          lotteries([Lottery]): lotteries to serialize
+    """
+    lotteries = list(lotteries)
+    winners = _prefetch_winners(lotteries)
+    drawing_ext = current_app.config['DRAWING_TIME_EXTENSION']
+    end_of_drawing = [str(mod_time(end, drawing_ext))
+                      for _, end in current_app.config['TIMEPOINTS']]
+
+    result = []
+    for lottery in lotteries:
+        classroom = find_classroom(lottery.classroom_id)
+        result.append({
+            'id': lottery.id,
+            'classroom_id': lottery.classroom_id,
+            'index': lottery.index,
+            'name': f'{classroom.grade}{classroom.name}.{lottery.index}',
+            'winners': winners.get(lottery.id, []),
+            'end_of_drawing': end_of_drawing[lottery.index],
+        })
+    return result
+
+
+def applications_to_list(applications):
+    """
+        same as `applications_schema.dump(applications)[0]`,
+        with each lottery serialized once by `lotteries_to_list`.
+        load `group_members` with their users and `group_members_not_rep`
+        eagerly to avoid queries for each application
+        Args:
+          applications([Application]): applications to serialize
+    """
+    applications = list(applications)
+    lotteries = Lottery.query.filter(
+        Lottery.id.in_({app.lottery_id for app in applications})
+    ).all() if applications else []
+    lotteries = {lottery['id']: lottery
+                 for lottery in lotteries_to_list(lotteries)}
+
+    return [{
+        'id': app.id,
+        'status': app.status,
+        'lottery': lotteries[app.lottery_id],
+        'is_rep': app.is_rep,
+        'group_members': [
+            {'id': member.id,
+             'public_id': encode_public_id(member.user.public_id)}
+            for member in app.group_members],
+        'is_member': bool(app.group_members_not_rep),
+    } for app in applications]
@@ -0,0 +1,160 @@
+from datetime import timedelta
+import time
+from flask import current_app
+from sqlalchemy import func
+from api.models import DrawJob, Lottery, db
+from api.draw import draw_one
+from api.scheduler import stage_due_lotteries
+from api.time_management import get_current_datetime
+
+__docs__ = """draw job queue
+
+    Draws requested through the API are stored in the `draw_job` table
+    and run by a worker process (`flask draw-worker`), so that HTTP
+    workers are not held while lotteries are drawn.
+
+    The worker records a heartbeat after each lottery. A running job
+    without a heartbeat for DRAW_JOB_TIMEOUT seconds is put back to the
+    queue, as its worker is considered dead. Running it again is safe:
+    `draw_one` returns the winners of lotteries already drawn.
+"""
+
+
+def enqueue_draw(index, lottery=None):
+    """
+        enqueue a draw job
+        Args:
+          index(int): time index of lotteries to draw
+          lottery(Lottery): the lottery to draw. None to draw all lotteries
+                            in `index`
+        Return:
+          job(DrawJob): the enqueued job
+    """
+    job = DrawJob(index=index, lottery_id=lottery and lottery.id)
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+
+def requeue_stale_jobs():
+    """
+        put running jobs without a heartbeat for DRAW_JOB_TIMEOUT seconds
+        back to the queue, forgetting their progress.
+        nothing is written unless such jobs are found
+        Return:
+          count(int): how many jobs are queued again
+    """
+    timeout = timedelta(seconds=current_app.config['DRAW_JOB_TIMEOUT'])
+    deadline = get_current_datetime() - timeout
+    stale = DrawJob.query.filter(
+        DrawJob.status == "running",
+        func.coalesce(DrawJob.heartbeat_at, DrawJob.started_at) < deadline)
+    if not db.session.query(stale.exists()).scalar():
+        return 0
+
+    count = (stale
+             .update({DrawJob.status: "queued",
+                      DrawJob.progress: 0,
+                      DrawJob.results_json: '[]',
+                      DrawJob.started_at: None,
+                      DrawJob.heartbeat_at: None},
+                     synchronize_session=False))
+    db.session.commit()
+    if count:
+        current_app.logger.warning(f'{count} stale draw job(s) requeued')
+    return count
+
+
+def claim_next_job():
+    """
+        take the oldest queued job and mark it running,
+        after stale jobs are queued again.
+        the status is changed with compare-and-set,
+        so that each job is claimed by only one worker
+        Return:
+          job(DrawJob): the claimed job, or None if the queue is empty
+    """
+    requeue_stale_jobs()
+    while True:
+        job = (DrawJob.query
+               .filter_by(status="queued")
+               .order_by(DrawJob.id)
+               .first())
+        if job is None:
+            db.session.commit()
+            return None
+
+        now = get_current_datetime()
+        claimed = (DrawJob.query
+                   .filter_by(id=job.id, status="queued")
+                   .update({DrawJob.status: "running",
+                            DrawJob.started_at: now,
+                            DrawJob.heartbeat_at: now},
+                           synchronize_session=False))
+        db.session.commit()
+        if claimed:
+            return DrawJob.query.get(job.id)
+
+
+def run_job(job):
+    """
+        draw the lotteries of the job, recording the result of each
+        Args:
+          job(DrawJob): the running job
+    """
+    if job.lottery_id is not None:
+        lottery_ids = [job.lottery_id]
+    else:
+        lottery_ids = [lottery.id for lottery
+                       in Lottery.query.filter_by(index=job.index)]
+    job.total = len(lottery_ids)
+    db.session.commit()
+
+    try:
+        for lottery_id in lottery_ids:
+            winners = draw_one(Lottery.query.get(lottery_id))
+            job.add_result(lottery_id, [winner.id for winner in winners])
+            job.heartbeat_at = get_current_datetime()
+            db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.exception(f'Draw job {job.id} failed')
+        job.status = "failed"
+        job.error = str(e)[:200]
+    else:
+        job.status = "done"
+    job.finished_at = get_current_datetime()
+    db.session.commit()
+
+
+def run_next_job():
+    """
+        claim and run one job
+        Return:
+          job(DrawJob): the job run, or None if the queue is empty
+    """
+    job = claim_next_job()
+    if job is not None:
+        run_job(job)
+    return job
+
+
+def run_worker(interval=1.0, max_interval=10.0):
+    """
+        run queued jobs forever.
+        lotteries are also staged in advance when PRE_DRAW is set.
+        application context is required.
+        Args:
+          interval(float): seconds to wait when the queue gets empty
+          max_interval(float): the wait is doubled while the queue stays
+                               empty, up to these seconds
+    """
+    wait = interval
+    while True:
+        if current_app.config['PRE_DRAW']:
+            stage_due_lotteries()
+        if run_next_job() is None:
+            time.sleep(wait)
+            wait = min(wait * 2, max_interval)
+        else:
+            wait = interval
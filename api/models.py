@@ -1,10 +1,63 @@
+from collections import defaultdict
+import json
+import sqlite3
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from cards.id import encode_public_id
 from api.time_management import get_current_datetime
 
 db = SQLAlchemy()
 
 
+def calc_advantage(win_count, lose_count, waiting_count):
+    """
+        returns multiplier indicating how more likely
+        the user is to win
+    """
+    if lose_count == 0:
+        return 1
+    else:
+        return 3 ** max(0, (        # at least 3^0 (= 1)
+            lose_count              # increase exponentially
+            + waiting_count / 2     # 2 waiting == 1 lose
+            - win_count
+            ))
+
+
+def advantage_expression(win_count, lose_count, waiting_count):
+    """
+        SQL expression of `calc_advantage`
+        Args:
+          win_count, lose_count, waiting_count: SQL expressions of counters
+    """
+    exponent = lose_count + waiting_count / 2.0 - win_count
+    return db.case(
+        [(lose_count == 0, 1.0)],
+        else_=db.func.power(3.0, db.case([(exponent > 0, exponent)],
+                                         else_=0)))
+
+
+def _sqlite_power(base, exponent):
+    """internal function
+        power() of SQL, for SQLite built without math functions
+    """
+    if base is None or exponent is None:
+        return None
+    return float(base) ** exponent
+
+
+@event.listens_for(Engine, 'connect')
+def _register_sqlite_functions(dbapi_connection, connection_record):
+    """internal function
+        register SQL functions used by `advantage_expression`
+        on each new SQLite connection.
+        power() is built in only from SQLite 3.35 with math functions
+    """
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.create_function('power', 2, _sqlite_power)
+
+
 class User(db.Model):
     """
         User model for DB
@@ -16,6 +69,8 @@ class User(db.Model):
             secret_id (int): secret id.
             win_count (int): how many times the user won
             lose_count (int): how many times the user lost
+            advantage (float): `calc_advantage` of the counters,
+                               kept up to date whenever they change
     """
     id = db.Column(db.Integer, primary_key=True)
     public_id = db.Column(db.Integer, unique=True)
@@ -24,6 +79,7 @@ class User(db.Model):
     win_count = db.Column(db.Integer, default=0)
     lose_count = db.Column(db.Integer, default=0)
     waiting_count = db.Column(db.Integer, default=0)
+    advantage = db.Column(db.Float, default=1, index=True)
     kind = db.Column(db.String(30))
     first_access = db.Column(db.Date, default=None)
 
@@ -32,6 +88,97 @@ class User(db.Model):
         return f'<User {encode_public_id(self.public_id)} {authority_str} ' + \
                f'{self.win_count}-{self.lose_count}/{self.waiting_count}>'
 
+    def update_advantage(self):
+        """
+            recompute `advantage` from the counters
+        """
+        self.advantage = calc_advantage(self.win_count or 0,
+                                        self.lose_count or 0,
+                                        self.waiting_count or 0)
+
+
+@event.listens_for(User, 'before_insert')
+@event.listens_for(User, 'before_update')
+def _update_advantage(mapper, connection, user):
+    user.update_advantage()
+
+
+def _user_advantage(connection, user_id):
+    """internal function
+        current `User.advantage` of the user, read on the connection
+        inserting the application
+    """
+    advantage = connection.scalar(
+        db.select([User.advantage]).where(User.id == user_id))
+    return 1 if advantage is None else advantage
+
+
+def repair_advantages():
+    """
+        recompute `User.advantage` of all users with one UPDATE, without commit
+        Return:
+          count(int): number of users updated
+    """
+    return User.query.update(
+        {User.advantage: advantage_expression(
+            User.win_count, User.lose_count, User.waiting_count)},
+        synchronize_session=False)
+
+
+def _status_counts():
+    """internal function
+        counters of each user rebuilt from `application`,
+        as a subquery (user_id, win_count, lose_count, waiting_count)
+    """
+    def count(status):
+        return db.func.count(db.case([(Application.status == status, 1)]))
+
+    return (db.session.query(Application.user_id.label('user_id'),
+                             count('won').label('win_count'),
+                             count('lose').label('lose_count'),
+                             count('waiting').label('waiting_count'))
+            .group_by(Application.user_id)
+            .subquery())
+
+
+def find_counter_mismatches():
+    """
+        users whose counters don't agree with the statuses
+        of their applications, with one query
+        Return:
+          mismatches([(int, int, int, int)]): user id and the right
+                                                win, lose and waiting counts
+    """
+    counts = _status_counts()
+    expected = [db.func.coalesce(counts.c[name], 0)
+                for name in ('win_count', 'lose_count', 'waiting_count')]
+    current = [db.func.coalesce(column, -1)
+               for column in (User.win_count, User.lose_count,
+                              User.waiting_count)]
+    return (db.session.query(User.id, *expected)
+            .outerjoin(counts, counts.c.user_id == User.id)
+            .filter(db.or_(*(value != right
+                             for value, right in zip(current, expected))))
+            .order_by(User.id)
+            .all())
+
+
+def repair_counters():
+    """
+        rebuild the counters (and `User.advantage`) of the users
+        found by `find_counter_mismatches` with one bulk UPDATE
+        of only those users, without commit
+        Return:
+          mismatches([(int, int, int, int)]): the users updated
+    """
+    mismatches = find_counter_mismatches()
+    db.session.bulk_update_mappings(User, [
+        {'id': user_id, 'win_count': win, 'lose_count': lose,
+         'waiting_count': waiting,
+         'advantage': calc_advantage(win, lose, waiting)}
+        for user_id, win, lose, waiting in mismatches])
+    return mismatches
+
 
 class Classroom(db.Model):
     """
@@ -94,25 +241,39 @@ class Application(db.Model):
             user_id (int): user id of this application
             status (Boolen): whether chosen or not. initalized with None
             is_rep (bool): whether rep of a group or not
-            advantage (int): how much advantage does user have
             created_on (date): when applciation is made
+            rank (int): position in the weighted random order of the draw.
+                        members of a group share the position of
+                        the last member. None until drawn
+            advantage (float): `User.advantage` of the applicant
+                               when the application is made
+            group_advantage (float): advantage shared by the group,
+                                     recorded only on reps
     """
     __tablename__ = 'application'
+    __table_args__ = (
+        # the waiting list of a lottery in the order of promotion
+        db.Index('ix_application_waiting_list',
+                 'lottery_id', 'created_on', 'status', 'rank'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     lottery_id = db.Column(db.Integer, db.ForeignKey(
         'lottery.id', ondelete='CASCADE'))
     lottery = db.relationship('Lottery', backref='application')
     user_id = db.Column(db.Integer, db.ForeignKey(
-        'user.id', ondelete='CASCADE'))
+        'user.id', ondelete='CASCADE'), index=True)
     user = db.relationship('User')
-    # status: [ pending, won, lose, waiting, waiting-pending(internal) ]
+    # status: [ pending, won, lose, waiting ]
     status = db.Column(db.String,
                        default="pending",
                        nullable=False)
     is_rep = db.Column(db.Boolean, default=False)
     created_on = db.Column(db.Date, nullable=False)
-    advantage = None
+    rank = db.Column(db.Integer, default=None)
+    advantage = db.Column(db.Float, default=lambda context: _user_advantage(
+        context.connection, context.current_parameters['user_id']))
+    group_advantage = db.Column(db.Float, default=None)
     group_members_not_rep = db.relationship(
         'GroupMember',
         backref='own_application',
@@ -144,43 +305,20 @@ class Application(db.Model):
             returns multiplier indicating how more likely
             the application is to win
         """
-        if self.advantage:
-            return self.advantage
-        elif self.user.lose_count == 0:
-            return 1
-        else:
-            return 3 ** max(0, (                # at least 3^0 (= 1)
-                self.user.lose_count            # increase exponentially
-                + self.user.waiting_count / 2   # 2 waiting == 1 lose
-                - self.user.win_count
-                ))
-
-    def set_advantage(self, advantage):
-        self.advantage = advantage
+        return self.advantage
 
     def set_status(self, new_status):
-        if new_status not in {"pending", "waiting-pending",
-                              "won", "lose", "waiting"}:
-            raise ValueError
-
-        if self.status == "won":
-            self.user.win_count -= 1
-        elif self.status == "lose":
-            self.user.lose_count -= 1
-        elif self.status == "waiting":
-            self.user.waiting_count -= 1
-
-        if new_status == "won":
-            self.user.win_count += 1
-        elif new_status == "lose":
-            self.user.lose_count += 1
-        elif new_status == "waiting":
-            self.user.waiting_count += 1
-
-        self.status = new_status
-
-        db.session.add(self.user)
+        """
+            change the status and the counters of the user, then commit.
+            use `StatusTransitions` to change many applications at once
+        """
         db.session.add(self)
+        db.session.flush()
+
+        transitions = StatusTransitions()
+        transitions.add(self.id, self.user_id, self.status, new_status)
+        transitions.apply()
+
         db.session.commit()
 
 
@@ -201,7 +339,7 @@ class GroupMember(db.Model):
     user = db.relationship('User')
 
     own_application_id = db.Column(db.Integer, db.ForeignKey(
-        'application.id', ondelete='CASCADE'))
+        'application.id', ondelete='CASCADE'), index=True)
 
     rep_application_id = db.Column(db.Integer, db.ForeignKey(
         'application.id', ondelete='CASCADE'))
@@ -228,6 +366,265 @@ class Error(db.Model):
         return f'<Error {self.code}: "{self.message}">'
 
 
+class DrawSeed(db.Model):
+    """
+        Root seed of all draws on one festival day.
+        see `api.draw_rng` for streams derived from it
+        DB contents:
+            id (int): seed unique id
+            date (date): the festival day
+            entropy (str): entropy of `numpy.random.SeedSequence`,
+                           in decimal as it does not fit in BIGINT
+    """
+    __tablename__ = 'draw_seed'
+
+    id = db.Column(db.Integer, primary_key=True)
+    date = db.Column(db.Date, unique=True, nullable=False)
+    entropy = db.Column(db.String(64), nullable=False)
+
+    def __repr__(self):
+        return f'<DrawSeed {self.date}>'
+
+
+class DrawRun(db.Model):
+    """
+        Record of one draw of a lottery, for post-mortems of the latency
+        DB contents:
+            id (int): run unique id
+            lottery_id (int): the drawn lottery
+            mode (str): [ draw, publish, sql, stage, promote ]
+                        publish: staged ranks are published
+                        sql: drawn by the SQL backend
+                        stage: ranks are staged in advance
+                        promote: applications on the waiting list
+                                 are promoted
+            applications (int): number of pending applications
+            groups (int): number of groups
+            winners (int): number of users who won
+            queries (int): number of SQL statements executed
+            load_seconds (float): seconds to load the applications
+            advantage_seconds (float): seconds to decide advantages
+                                       of groups
+            sample_seconds (float): seconds to choose winners and
+                                    the waiting list
+            draw_seconds (float): seconds to rank the applications,
+                                  including advantage_seconds
+                                  and sample_seconds
+            write_seconds (float): seconds to write statuses and counters
+            commit_seconds (float): seconds to commit
+            total_seconds (float): seconds of the whole draw
+            seed_json (str): JSON of the entropy and the spawn key
+                             of the random stream.
+                             None when the stream is given by the caller
+            created_at (datetime): when the draw finished
+    """
+    __tablename__ = 'draw_run'
+
+    id = db.Column(db.Integer, primary_key=True)
+    lottery_id = db.Column(db.Integer, db.ForeignKey(
+        'lottery.id', ondelete='CASCADE'), index=True)
+    mode = db.Column(db.String(20), nullable=False)
+    applications = db.Column(db.Integer)
+    groups = db.Column(db.Integer)
+    winners = db.Column(db.Integer)
+    queries = db.Column(db.Integer)
+    load_seconds = db.Column(db.Float)
+    advantage_seconds = db.Column(db.Float)
+    sample_seconds = db.Column(db.Float)
+    draw_seconds = db.Column(db.Float)
+    write_seconds = db.Column(db.Float)
+    commit_seconds = db.Column(db.Float)
+    total_seconds = db.Column(db.Float)
+    seed_json = db.Column(db.Text)
+    created_at = db.Column(db.DateTime(timezone=True))
+
+    def __init__(self, **kwargs):
+        """
+            construct object with column `created_at` automatically set
+        """
+        super().__init__(created_at=get_current_datetime(), **kwargs)
+
+    def __repr__(self):
+        return f'<DrawRun {self.lottery_id} {self.mode} ' + \
+               f'{self.total_seconds}s>'
+
+    def get_seed(self):
+        """
+            returns the seed as a dict of entropy and spawn_key, or None
+        """
+        return json.loads(self.seed_json) if self.seed_json else None
+
+    def set_seed(self, entropy, spawn_key):
+        """
+            record the seed of the random stream.
+            the 128-bit entropy is kept in decimal as `DrawSeed` does,
+            since JSON clients can't hold it as a number
+        """
+        if isinstance(entropy, int):
+            entropy = str(entropy)
+        self.seed_json = json.dumps({'entropy': entropy,
+                                     'spawn_key': list(spawn_key)})
+
+    # phases of `api.draw_engine.draw_frame` and the rest of the ranking,
+    # summed up into `draw_seconds`
+    draw_phases = ('advantage', 'sample', 'rank', 'draw')
+
+    def set_timings(self, seconds, total):
+        """
+            record seconds of each phase measured by `api.utils.PhaseTimer`
+        """
+        for phase in ('load', 'advantage', 'sample', 'write', 'commit'):
+            setattr(self, f'{phase}_seconds', seconds.get(phase))
+        drawn = [seconds[phase] for phase in self.draw_phases
+                 if phase in seconds]
+        self.draw_seconds = sum(drawn) if drawn else None
+        self.total_seconds = total
+
+
+class DrawJob(db.Model):
+    """
+        Draw job model, the queue of draws run by the worker process
+        DB contents:
+            id (int): job unique id
+            index (int): time index of lotteries to draw
+            lottery_id (int): the lottery to draw.
+                              None to draw all lotteries in `index`
+            status (str): [ queued, running, done, failed ]
+            progress (int): how many lotteries are drawn
+            total (int): how many lotteries are to be drawn
+            results_json (str): JSON list of per-lottery results
+            error (str): the error message when failed
+            created_at (datetime): when the job is enqueued
+            started_at (datetime): when the worker started the job
+            heartbeat_at (datetime): when the worker last reported
+                                     that it is alive
+            finished_at (datetime): when the job is done or failed
+    """
+    __tablename__ = 'draw_job'
+
+    id = db.Column(db.Integer, primary_key=True)
+    index = db.Column(db.Integer, nullable=False)
+    lottery_id = db.Column(db.Integer, db.ForeignKey(
+        'lottery.id', ondelete='CASCADE'))
+    status = db.Column(db.String(20), default="queued", nullable=False,
+                       index=True)
+    progress = db.Column(db.Integer, default=0, nullable=False)
+    total = db.Column(db.Integer, default=0, nullable=False)
+    results_json = db.Column(db.Text, default='[]', nullable=False)
+    error = db.Column(db.String(200))
+    created_at = db.Column(db.DateTime(timezone=True))
+    started_at = db.Column(db.DateTime(timezone=True))
+    heartbeat_at = db.Column(db.DateTime(timezone=True))
+    finished_at = db.Column(db.DateTime(timezone=True))
+
+    def __init__(self, **kwargs):
+        """
+            construct object with column `created_at` automatically set
+        """
+        super().__init__(created_at=get_current_datetime(), **kwargs)
+
+    def __repr__(self):
+        return f'<DrawJob {self.id} {self.status} ' + \
+               f'{self.progress}/{self.total}>'
+
+    def get_results(self):
+        """
+            returns list of per-lottery results
+        """
+        return json.loads(self.results_json or '[]')
+
+    def add_result(self, lottery_id, winner_ids):
+        """
+            record the winners of one lottery and count up the progress
+        """
+        results = self.get_results()
+        results.append({'lottery_id': lottery_id, 'winners': winner_ids})
+        self.results_json = json.dumps(results)
+        self.progress = len(results)
+
+
+STATUSES = {"pending", "won", "lose", "waiting"}
+# statuses counted in `User`, and the index of the counter in deltas
+COUNTED_STATUSES = {"won": 0, "lose": 1, "waiting": 2}
+
+
+class StatusTransitions:
+    """
+        batch of status changes of applications.
+        `apply` issues set-based UPDATEs of `application.status` and
+        adds the aggregated counter deltas to `user` with the new advantage,
+        without commit.
+    """
+    # maximum number of ids in one `IN` clause
+    chunk_size = 500
+
+    def __init__(self):
+        self.statuses = defaultdict(list)   # new status -> application ids
+        self.deltas = defaultdict(lambda: [0, 0, 0])    # user id -> deltas
+
+    def __len__(self):
+        return sum(len(ids) for ids in self.statuses.values())
+
+    def add(self, application_id, user_id, old_status, new_status):
+        """
+            record one status change
+            Args:
+              application_id(int): id of the application to change
+              user_id(int): id of the owner of the application
+              old_status(str): current status of the application
+              new_status(str): status to set
+        """
+        if new_status not in STATUSES:
+            raise ValueError(new_status)
+        if old_status == new_status:
+            return
+
+        self.statuses[new_status].append(application_id)
+        delta = self.deltas[user_id]
+        if old_status in COUNTED_STATUSES:
+            delta[COUNTED_STATUSES[old_status]] -= 1
+        if new_status in COUNTED_STATUSES:
+            delta[COUNTED_STATUSES[new_status]] += 1
+
+    def apply(self):
+        """
+            write all recorded changes into the current transaction
+        """
+        for status, ids in self.statuses.items():
+            for chunk in self._chunks(ids):
+                Application.query \
+                    .filter(Application.id.in_(chunk)) \
+                    .update({Application.status: status},
+                            synchronize_session=False)
+
+        # users sharing the same deltas are updated in one statement
+        users_by_delta = defaultdict(list)
+        for user_id, delta in self.deltas.items():
+            if any(delta):
+                users_by_delta[tuple(delta)].append(user_id)
+        for (win, lose, waiting), ids in users_by_delta.items():
+            # SET refers to the counters before the UPDATE
+            new_counts = (User.win_count + win,
+                          User.lose_count + lose,
+                          User.waiting_count + waiting)
+            for chunk in self._chunks(ids):
+                User.query \
+                    .filter(User.id.in_(chunk)) \
+                    .update({User.win_count: new_counts[0],
+                             User.lose_count: new_counts[1],
+                             User.waiting_count: new_counts[2],
+                             User.advantage: advantage_expression(
+                                 *new_counts)},
+                            synchronize_session=False)
+
+        self.statuses.clear()
+        self.deltas.clear()
+
+    def _chunks(self, ids):
+        for i in range(0, len(ids), self.chunk_size):
+            yield ids[i:i + self.chunk_size]
+
+
 def app2member(application):
     return GroupMember(user_id=application.user_id,
                        own_application=application)
@@ -2,15 +2,26 @@ from itertools import chain
 from jinja2 import Environment, FileSystemLoader
 
 from flask import Blueprint, jsonify, g, request, current_app
-from api.models import Lottery, Classroom, User, Application, db, apps2members
+from api.models import (
+    Lottery,
+    User,
+    Application,
+    DrawJob,
+    DrawRun,
+    GroupMember,
+    db,
+    apps2members,
+    find_counter_mismatches,
+    repair_counters
+)
 from api.schemas import (
+    draw_job_schema,
+    draw_runs_schema,
+    dry_run_schema,
+    dry_runs_schema,
     user_schema,
     users_schema,
-    classrooms_schema,
-    classroom_schema,
     application_schema,
-    applications_schema,
-    lotteries_schema,
     lottery_schema
 )
 from api.auth import (
@@ -29,10 +40,24 @@ from api.time_management import (
     get_prev_time_index
 )
 from api.draw import (
+    AlreadyPromotedError,
+    calc_group_advantage,
     draw_one,
     draw_all_at_index,
+    dry_run_one,
+    dry_run_all_at_index,
+    promote_one,
+    recut_one,
 )
+from api.jobs import enqueue_draw
+from api.catalog import get_classroom_catalog, find_classroom
 from api.error import error_response
+from api.fast_json import (
+    json_response,
+    classrooms_to_list,
+    lotteries_to_list,
+    applications_to_list
+)
 from api.utils import calc_sha256
 
 from cards.id import encode_public_id
@@ -50,9 +75,8 @@ def list_classrooms():
 #     filter = request.args.get('filter')
 #     sort = request.args.get('sort')
 
-    classrooms = Classroom.query.all()
-    result = classrooms_schema.dump(classrooms)[0]
-    return jsonify(result)
+    classrooms = get_classroom_catalog().classrooms
+    return json_response(classrooms_to_list(classrooms))
 
 
 @bp.route('/classrooms/<int:idx>')
@@ -61,11 +85,10 @@ def list_classroom(idx):
     """
         return infomation about specified classroom
     """
-    classroom = Classroom.query.get(idx)
+    classroom = get_classroom_catalog().by_id.get(idx)
     if classroom is None:
         return error_response(7)  # Not found
-    result = classroom_schema.dump(classroom)[0]
-    return jsonify(result)
+    return json_response(classrooms_to_list([classroom])[0])
 
 
 @bp.route('/lotteries')
@@ -79,8 +102,7 @@ def list_lotteries():
 #     sort = request.args.get('sort')
 
     lotteries = Lottery.query.all()
-    result = lotteries_schema.dump(lotteries)[0]
-    return jsonify(result)
+    return json_response(lotteries_to_list(lotteries))
 
 
 @bp.route('/lotteries/available')
@@ -99,8 +121,7 @@ def list_available_lotteries():
         return jsonify([])
     lotteries = Lottery.query.filter_by(index=index)
 
-    result = lotteries_schema.dump(lotteries)[0]
-    return jsonify(result)
+    return json_response(lotteries_to_list(lotteries))
 
 
 @bp.route('/lotteries/<int:idx>', methods=['GET'])
@@ -199,6 +220,9 @@ def apply_lottery(idx):
         is_rep=True,
         group_members=apps2members(members_app))
     db.session.add(rep_application)
+    db.session.flush()
+    rep_application.group_advantage = calc_group_advantage(
+        rep_application, members_app)
 
     # 9.
     db.session.commit()
@@ -266,11 +290,14 @@ def list_applications():
 #     sort = request.args.get('sort')
 
     user = User.query.filter_by(id=g.token_data['user_id']).first()
-    applications = Application.query.filter_by(
-        user_id=user.id,
-        created_on=get_current_datetime().date())
-    result = applications_schema.dump(applications)[0]
-    return jsonify(result)
+    applications = (Application.query
+                    .filter_by(user_id=user.id,
+                               created_on=get_current_datetime().date())
+                    .options(db.selectinload(Application.group_members)
+                             .joinedload(GroupMember.user),
+                             db.selectinload(
+                                 Application.group_members_not_rep)))
+    return json_response(applications_to_list(applications))
 
 
 @bp.route('/applications/<int:idx>', methods=['GET'])
@@ -298,7 +325,10 @@ def cancel_application(idx):
         cancel the application.
         specify the application id in the URL.
     """
-    application = Application.query.get(idx)
+    application = (Application.query
+                   .options(db.selectinload(Application.group_members)
+                            .joinedload(GroupMember.own_application))
+                   .get(idx))
     if application is None:
         return error_response(7)  # Not found
     if application.status != "pending":
@@ -331,12 +361,81 @@ def draw_lottery(idx):
     if index != lottery.index:
         return error_response(6)  # Not acceptable time
 
+    if is_dry_run():
+        result = dry_run_schema.dump(dry_run_one(lottery))
+        return jsonify(result[0])
+
+    if current_app.config['DRAW_JOB_QUEUE']:
+        job = enqueue_draw(index, lottery)
+        return jsonify(draw_job_schema.dump(job)[0]), 202
+
     winners = draw_one(lottery)
 
     result = users_schema.dump(winners)
     return jsonify(result[0])
 
 
+@bp.route('/lotteries/<int:idx>/recut', methods=['POST'])
+@spec('api/lotteries/recut.yml')
+@login_required('admin')
+def recut_lottery(idx):
+    """
+        change the numbers of winners and waiting applications
+        of the drawn lottery as adminstrator.
+        statuses are decided from the ranks recorded by the draw
+    """
+    lottery = Lottery.query.get(idx)
+    if lottery is None:
+        return error_response(7)  # Not found
+
+    numbers = request.get_json(silent=True) or {}
+    winners_num = numbers.get('winners_num',
+                              current_app.config['WINNERS_NUM'])
+    waiting_num = numbers.get('waiting_num',
+                              current_app.config['WAITING_NUM'])
+    if not all(is_number(num) and num >= 0
+               for num in (winners_num, waiting_num)):
+        return error_response(2)  # Invalid request
+
+    try:
+        winners = recut_one(lottery, winners_num, waiting_num)
+    except AlreadyPromotedError:
+        return error_response(25)  # Already promoted
+
+    result = users_schema.dump(winners)
+    return jsonify(result[0])
+
+
+@bp.route('/lotteries/<int:idx>/promote', methods=['POST'])
+@spec('api/lotteries/promote.yml')
+@login_required('admin')
+def promote_lottery(idx):
+    """
+        promote applications on the waiting list of the drawn lottery
+        to winners as adminstrator, when winners don't show up
+    """
+    lottery = Lottery.query.get(idx)
+    if lottery is None:
+        return error_response(7)  # Not found
+
+    count = (request.get_json(silent=True) or {}).get('count', 1)
+    if not is_number(count) or count <= 0:
+        return error_response(2)  # Invalid request
+
+    winners = promote_one(lottery, count)
+
+    result = users_schema.dump(winners)
+    return jsonify(result[0])
+
+
+def is_number(value):
+    """
+        whether the value in the request body is an integer.
+        JSON true and false are rejected, as bool is a subclass of int
+    """
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
 @bp.route('/draw_all', methods=['POST'])
 @spec('api/draw_all.yml')
 @login_required('admin')
@@ -350,6 +449,14 @@ def draw_all_lotteries():
     except (OutOfHoursError, OutOfAcceptingHoursError):
         return error_response(6)  # Not acceptable time
 
+    if is_dry_run():
+        result = dry_runs_schema.dump(dry_run_all_at_index(index))
+        return jsonify(result[0])
+
+    if current_app.config['DRAW_JOB_QUEUE']:
+        job = enqueue_draw(index)
+        return jsonify(draw_job_schema.dump(job)[0]), 202
+
     winners = draw_all_at_index(index)
 
     flattened = list(chain.from_iterable(winners))
@@ -357,6 +464,68 @@ def draw_all_lotteries():
     return jsonify(result[0])
 
 
+def is_dry_run():
+    """
+        whether the draw is requested with `?dry_run=1`.
+        nothing is written to the database in a dry run
+    """
+    return request.args.get('dry_run', '0').lower() in ('1', 'true')
+
+
+@bp.route('/draw_jobs/<int:idx>', methods=['GET'])
+@spec('api/draw_jobs/idx.yml')
+@login_required('admin')
+def get_draw_job(idx):
+    """
+        return progress and results of the draw job
+    """
+    job = DrawJob.query.get(idx)
+    if job is None:
+        return error_response(7)  # Not found
+    result = draw_job_schema.dump(job)[0]
+    return jsonify(result)
+
+
+@bp.route('/draw_runs', methods=['GET'])
+@spec('api/draw_runs.yml')
+@login_required('admin')
+def list_draw_runs():
+    """
+        return records of draws, newest first.
+        filtered by `lottery_id` and limited by `limit` (100 by default)
+    """
+    lottery_id = request.args.get('lottery_id', type=int)
+    limit = request.args.get('limit', 100, type=int)
+    if limit <= 0:
+        return error_response(2)  # Invalid request
+
+    runs = DrawRun.query
+    if lottery_id is not None:
+        runs = runs.filter_by(lottery_id=lottery_id)
+    runs = runs.order_by(DrawRun.id.desc()).limit(limit).all()
+    result = draw_runs_schema.dump(runs)
+    return jsonify(result[0])
+
+
+@bp.route('/repair_counters', methods=['POST'])
+@spec('api/repair_counters.yml')
+@login_required('admin')
+def repair_user_counters():
+    """
+        rebuild win/lose/waiting counters of users from their applications.
+        with `?dry_run=1`, the users to repair are only reported
+    """
+    if is_dry_run():
+        mismatches = find_counter_mismatches()
+    else:
+        mismatches = repair_counters()
+        db.session.commit()
+
+    return jsonify([{'user_id': user_id, 'win_count': win,
+                     'lose_count': lose, 'waiting_count': waiting}
+                    for user_id, win, lose, waiting in mismatches])
+
+
 @bp.route('/status', methods=['GET'])
 @spec('api/status.yml')
 @login_required('normal', 'checker')
@@ -463,14 +632,14 @@ def results():
     data = []
 
     for lottery in lotteries:
-        cl = Classroom.query.get(lottery.classroom_id)
+        cl = find_classroom(lottery.classroom_id)
 
         lottery_result = []
         for status in statuses:
             public_ids = list(sorted(public_id_generator(lottery, status)))
             lottery_result.append({'status': status, 'winners': public_ids})
 
-        data.append({'classroom': str(cl),
+        data.append({'classroom': f'{cl.grade}{cl.name}',
                      'statuses': lottery_result})
 
     # 6.
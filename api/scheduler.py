@@ -0,0 +1,51 @@
+import time
+from flask import current_app
+from api.models import Lottery
+from api.draw import stage_one
+from api.time_management import (
+    get_draw_time_index,
+    OutOfHoursError,
+    OutOfAcceptingHoursError
+)
+
+__docs__ = """pre-draw scheduler
+
+    As soon as applications for a time index are closed
+    (TIMEPOINT_END_MARGIN after the end of the time point),
+    the lotteries of the index are drawn in advance by `stage_one`.
+    Only the ranks are recorded then, and the draw requested
+    by the administrator publishes them.
+"""
+
+
+def stage_due_lotteries(time=None):
+    """
+        stage all lotteries whose applications are closed
+        Args:
+          time(datetime.datetime): the time. current time if None
+        Return:
+          lottery_ids([int]): ids of the lotteries staged by this call
+    """
+    try:
+        index = get_draw_time_index(time)
+    except (OutOfHoursError, OutOfAcceptingHoursError):
+        return []
+
+    staged = []
+    for lottery in Lottery.query.filter_by(index=index).all():
+        if stage_one(lottery):
+            current_app.logger.info(f'{lottery} is staged')
+            staged.append(lottery.id)
+    return staged
+
+
+def run_scheduler(interval=30.0):
+    """
+        stage lotteries forever.
+        application context is required.
+        Args:
+          interval(float): seconds between checks
+    """
+    while True:
+        stage_due_lotteries()
+        time.sleep(interval)
@@ -1,6 +1,6 @@
 from marshmallow import Schema, fields
 from flask import current_app
-from api.models import Application, Lottery
+from api.models import Application, User, db
 from cards.id import encode_public_id
 from api.time_management import mod_time
 import base64
@@ -44,16 +44,12 @@ class ApplicationSchema(Schema):
     is_member = fields.Method("get_is_member", dump_only=True)
 
     def get_lottery(self, application):
-        lottery = Lottery.query.get(application.lottery_id)
-        return lottery_schema.dump(lottery)[0]
+        return lottery_schema.dump(application.lottery)[0]
 
     def get_is_member(self, application):
-        index = application.lottery.index
-        reps = (app for app in Application.query.all()
-                if app.is_rep and app.lottery.index == index)
-        return any(application.id == member.own_application.id
-                   for rep in reps
-                   for member in rep.group_members)
+        # looked up by the index of GroupMember.own_application_id,
+        # or taken from `group_members_not_rep` if it is loaded eagerly
+        return bool(application.group_members_not_rep)
 
 
 application_schema = ApplicationSchema()
@@ -94,10 +90,14 @@ class LotterySchema(Schema):
         return f"{grade}{name}.{index}"
 
     def get_winners(self, lottery):
-        winners = Application.query.filter_by(
-            lottery_id=lottery.id, created_on=get_current_datetime().date(),
-            status="won").all()
-        return [winner.public_id for winner in winners]
+        winners = (db.session.query(User.public_id)
+                   .join(Application, Application.user_id == User.id)
+                   .filter(Application.lottery_id == lottery.id,
+                           Application.created_on ==
+                           get_current_datetime().date(),
+                           Application.status == "won")
+                   .order_by(Application.id))
+        return [encode_public_id(public_id) for public_id, in winners]
 
     def calc_end_of_drawing(self, lottery):
         index = lottery.index
@@ -110,6 +110,63 @@ lottery_schema = LotterySchema()
 lotteries_schema = LotterySchema(many=True)
 
 
+class DrawJobSchema(Schema):
+    id = fields.Int(dump_only=True)
+    index = fields.Int()
+    lottery_id = fields.Int()
+    status = fields.Str()
+    progress = fields.Int()
+    total = fields.Int()
+    results = fields.Method("get_results", dump_only=True)
+    error = fields.Str()
+    created_at = fields.DateTime()
+    started_at = fields.DateTime()
+    finished_at = fields.DateTime()
+
+    def get_results(self, job):
+        return job.get_results()
+
+
+draw_job_schema = DrawJobSchema()
+
+
+class DrawRunSchema(Schema):
+    id = fields.Int(dump_only=True)
+    lottery_id = fields.Int()
+    mode = fields.Str()
+    applications = fields.Int()
+    groups = fields.Int()
+    winners = fields.Int()
+    queries = fields.Int()
+    load_seconds = fields.Float()
+    advantage_seconds = fields.Float()
+    sample_seconds = fields.Float()
+    draw_seconds = fields.Float()
+    write_seconds = fields.Float()
+    commit_seconds = fields.Float()
+    total_seconds = fields.Float()
+    seed = fields.Method("get_seed", dump_only=True)
+    created_at = fields.DateTime()
+
+    def get_seed(self, run):
+        return run.get_seed()
+
+
+draw_runs_schema = DrawRunSchema(many=True)
+
+
+class DryRunSchema(Schema):
+    lottery_id = fields.Int()
+    applications = fields.Int()
+    winners = fields.Nested(UserSchema, many=True)
+    waiting = fields.Int()
+    timings = fields.Dict()
+
+
+dry_run_schema = DryRunSchema()
+dry_runs_schema = DryRunSchema(many=True)
+
+
 class ErrorSchema(Schema):
     code = fields.Int()
     message = fields.Str()
@@ -1,5 +1,10 @@
+from contextlib import contextmanager
 import hashlib
 import os
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 __docs__ = """collection of small utilities"""
 
 
@@ -13,3 +18,70 @@ def calc_sha256(_file):
 
     with open(_file, 'r') as f:
         return hashlib.sha256(f.read().encode()).hexdigest()
+
+
+# statement lists of `count_queries` blocks open in each thread
+_recorders = threading.local()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _record_statement(conn, cursor, statement, *args):
+    """internal function
+        append the statement to the lists of `count_queries` blocks
+        open in this thread on the engine.
+        the listener stays for the life of the process, since adding and
+        removing listeners is not safe while other threads execute
+    """
+    for engine, statements in getattr(_recorders, 'blocks', ()):
+        if conn.engine is engine:
+            statements.append(statement)
+
+
+@contextmanager
+def count_queries(engine):
+    """record SQL statements executed on the engine inside the block.
+        statements of other threads are not recorded
+        Args:
+            engine (sqlalchemy.engine.Engine): engine to watch
+        Yields:
+            statements (list of str): executed statements
+    """
+    statements = []
+    blocks = _recorders.__dict__.setdefault('blocks', [])
+    block = (engine, statements)
+    blocks.append(block)
+    try:
+        yield statements
+    finally:
+        # by identity, as lists of other blocks may hold the same statements
+        blocks[:] = [other for other in blocks if other is not block]
+
+
+class PhaseTimer:
+    """measure seconds spent in each phase
+        Attributes:
+            seconds (dict): phase name -> seconds
+    """
+    def __init__(self):
+        self.seconds = {}
+        self.start = self._last = time.perf_counter()
+
+    def lap(self, phase):
+        """end the phase, which began at the end of the previous one
+            Args:
+                phase (str): name of the phase
+        """
+        now = time.perf_counter()
+        self.seconds[phase] = self.seconds.get(phase, 0) + now - self._last
+        self._last = now
+
+    def sum(self, *phases):
+        """seconds spent in the phases
+            Args:
+                phases (str): names of the phases
+        """
+        return sum(self.seconds.get(phase, 0) for phase in phases)
+
+    @property
+    def total(self):
+        return self._last - self.start
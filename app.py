@@ -1,4 +1,13 @@
+import click
 from api.app import create_app, initdb, generate
+from api.models import (
+    db,
+    find_counter_mismatches,
+    repair_advantages,
+    repair_counters
+)
+from api.jobs import run_worker
+from api.scheduler import run_scheduler
 
 app = create_app()
 
@@ -11,3 +20,35 @@ def initdb_():
 @app.cli.command("generate")
 def generate_():
     generate()
+
+
+@app.cli.command("repair-advantages")
+def repair_advantages_():
+    count = repair_advantages()
+    db.session.commit()
+    click.echo(f'{count} users updated')
+
+
+@app.cli.command("repair-counters")
+@click.option('--check', is_flag=True,
+              help="only report the users to repair")
+def repair_counters_(check):
+    if check:
+        mismatches = find_counter_mismatches()
+    else:
+        mismatches = repair_counters()
+        db.session.commit()
+    for user_id, win, lose, waiting in mismatches:
+        click.echo(f'user {user_id}: {win}-{lose}/{waiting}')
+    click.echo(f'{len(mismatches)} users '
+               f'{"to repair" if check else "repaired"}')
+
+
+@app.cli.command("draw-worker")
+def draw_worker_():
+    run_worker()
+
+
+@app.cli.command("pre-draw")
+def pre_draw_():
+    run_scheduler()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+#
+# draw benchmark
+#
+# Generate a synthetic festival day into SQLite or PostgreSQL, then time
+#   draw_one:          each lottery of index 0, one by one
+#   draw_all_at_index: all lotteries of index 1 at once
+#   phases:            load_frame, draw_frame and write_results + commit
+#                      for each lottery of index 2
+# with the number of SQL statements executed in each of them.
+# Results are written into a JSON file to be compared across commits.
+#
+# Users have random win/lose/waiting counters. Each round, every party
+# of 1-4 users applies to one lottery of the index with the probability
+# -a, choosing the lottery by its popularity (Zipf with the exponent -s).
+#
+# The database is dropped and created again. Never point it at
+# a database in use.
+#
+# Usage: python benchmarks/draw.py [-d postgresql://...] [-u 30000]
+#            [--backend python|sql] [-j 4] [-o result.json]
+
+import sys
+import os
+sys.path.append(os.getcwd())  # noqa: E402
+import argparse  # noqa: E402
+import json  # noqa: E402
+import subprocess  # noqa: E402
+import tempfile  # noqa: E402
+import time  # noqa: E402
+import numpy as np  # noqa: E402
+
+parser = argparse.ArgumentParser(
+    description='Benchmark the draw on a synthetic festival day')
+parser.add_argument("-d", "--database", type=str,
+                    help="SQLAlchemy database URI. "
+                         "a temporary SQLite file if omitted")
+parser.add_argument("-u", "--users", type=int, default=30000,
+                    help="number of users")
+parser.add_argument("-a", "--apply", type=float, default=0.8,
+                    help="probability that a party applies in each index")
+parser.add_argument("-s", "--skew", type=float, default=1.0,
+                    help="Zipf exponent of the popularity of lotteries")
+parser.add_argument("-g", "--party-sizes", type=float, nargs=4,
+                    default=[0.55, 0.25, 0.12, 0.08],
+                    help="share of parties of 1, 2, 3 and 4 users")
+parser.add_argument("--backend", choices=['python', 'sql'],
+                    default='python', help="DRAW_BACKEND")
+parser.add_argument("-j", "--parallelism", type=int, default=1,
+                    help="DRAW_PARALLELISM of draw_all_at_index")
+parser.add_argument("--seed", type=int, default=0, help="random seed")
+parser.add_argument("-o", "--output", type=str,
+                    help="write the results into this JSON file")
+args = parser.parse_args()
+
+os.environ['FLASK_CONFIGURATION'] = 'testing'
+from api.app import create_app, generate  # noqa: E402
+from api.config import BaseConfig  # noqa: E402
+from api.models import (  # noqa: E402
+    User,
+    Lottery,
+    Application,
+    GroupMember,
+    calc_advantage,
+    db
+)
+from api.draw import (  # noqa: E402
+    draw_one,
+    draw_all_at_index,
+    group_advantage_calculation
+)
+from api.draw_engine import load_frame, draw_frame, write_results  # noqa
+from api.draw_rng import lottery_rng  # noqa: E402
+from api.time_management import get_current_datetime  # noqa: E402
+from api.utils import count_queries  # noqa: E402
+
+rng = np.random.default_rng(args.seed)
+
+
+def make_parties(users):
+    """split user ids into parties of 1-4 users"""
+    shares = np.array(args.party_sizes) / sum(args.party_sizes)
+    sizes = rng.choice(4, size=len(users), p=shares) + 1
+    bounds = np.cumsum(sizes)
+    bounds = bounds[bounds < len(users)]
+    return np.split(rng.permutation(users), bounds)
+
+
+def generate_dataset():
+    """create tables, classrooms, lotteries and synthetic applications
+        Return:
+          stats(dict): numbers of generated rows
+    """
+    db.drop_all()
+    db.create_all()
+    generate()
+
+    first_id = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+    counters = rng.integers(0, [2, 4, 3], size=(args.users, 3))
+    users = []
+    for i, (win, lose, waiting) in enumerate(counters.tolist()):
+        users.append({
+            'id': first_id + i, 'public_id': 10 ** 7 + i,
+            'secret_id': f'benchmark{i}', 'authority': 'normal',
+            'kind': 'student', 'win_count': win, 'lose_count': lose,
+            'waiting_count': waiting,
+            'advantage': calc_advantage(win, lose, waiting)})
+    db.session.bulk_insert_mappings(User, users)
+    advantages = {user['id']: user['advantage'] for user in users}
+
+    today = get_current_datetime().date()
+    next_id = (db.session.query(db.func.max(Application.id)).scalar()
+               or 0) + 1
+    applications, members = [], []
+    n_groups = 0
+    for index in range(4):
+        lottery_ids = [lottery.id for lottery
+                       in Lottery.query.filter_by(index=index)
+                                       .order_by(Lottery.id)]
+        popularity = 1 / np.arange(1, len(lottery_ids) + 1) ** args.skew
+        popularity /= popularity.sum()
+        for party in make_parties([user['id'] for user in users]):
+            if rng.random() >= args.apply:
+                continue
+            lottery_id = lottery_ids[rng.choice(len(lottery_ids),
+                                                p=popularity)]
+            party = party.tolist()
+            rep_id = next_id
+            for i, user_id in enumerate(party):
+                applications.append({
+                    'id': next_id, 'lottery_id': lottery_id,
+                    'user_id': user_id, 'status': 'pending',
+                    'is_rep': len(party) > 1 and i == 0,
+                    'created_on': today,
+                    'advantage': advantages[user_id]})
+                if i > 0:
+                    members.append({'user_id': user_id,
+                                    'own_application_id': next_id,
+                                    'rep_application_id': rep_id})
+                next_id += 1
+            if len(party) > 1:
+                n_groups += 1
+                party_advantages = np.array(
+                    [advantages[user_id] for user_id in party])
+                applications[-len(party)]['group_advantage'] = float(
+                    group_advantage_calculation(
+                        party_advantages, np.zeros(len(party), dtype=int),
+                        np.arange(len(party)) == 0)[0])
+    db.session.bulk_insert_mappings(Application, applications)
+    db.session.bulk_insert_mappings(GroupMember, members)
+    db.session.commit()
+    # statistics for the planner, as autovacuum would make them
+    with db.engine.connect() as connection:
+        connection.execution_options(isolation_level='AUTOCOMMIT') \
+            .execute('ANALYZE')
+    return {'users': args.users, 'applications': len(applications),
+            'groups': n_groups, 'lotteries': Lottery.query.count()}
+
+
+def measure(function, *function_args):
+    """run the function, returning the result, seconds and statements"""
+    with count_queries(db.engine) as statements:
+        start = time.perf_counter()
+        result = function(*function_args)
+        seconds = time.perf_counter() - start
+    return result, seconds, len(statements)
+
+
+def bench_draw_one(index):
+    results = []
+    for lottery in Lottery.query.filter_by(index=index).order_by(Lottery.id):
+        applications = Application.query.filter_by(
+            lottery_id=lottery.id).count()
+        rng = lottery_rng(lottery)
+        _, seconds, queries = measure(draw_one, lottery, rng)
+        results.append({'lottery_id': lottery.id,
+                        'applications': applications,
+                        'seconds': seconds, 'queries': queries})
+    return results
+
+
+def bench_draw_all(index):
+    _, seconds, queries = measure(draw_all_at_index, index)
+    return {'index': index, 'seconds': seconds, 'queries': queries}
+
+
+def bench_phases(index):
+    winners_num = app.config['WINNERS_NUM']
+    waiting_num = app.config['WAITING_NUM']
+    results = []
+    for lottery in Lottery.query.filter_by(index=index).order_by(Lottery.id):
+        rng = lottery_rng(lottery)
+        frame, load, load_queries = measure(load_frame, lottery)
+        ranks, draw, _ = measure(draw_frame, frame, winners_num, waiting_num,
+                                 group_advantage_calculation, rng)
+
+        def write():
+            write_results(frame, ranks, winners_num, waiting_num)
+            db.session.commit()
+        _, write_seconds, write_queries = measure(write)
+        results.append({'lottery_id': lottery.id,
+                        'applications': len(frame),
+                        'load': load, 'load_queries': load_queries,
+                        'draw': draw,
+                        'write': write_seconds,
+                        'write_queries': write_queries})
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+database = args.database
+if database is None:
+    database = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'draw.db')
+
+app = create_app()
+app.config.update(SQLALCHEMY_DATABASE_URI=database,
+                  WINNERS_NUM=BaseConfig.WINNERS_NUM,
+                  WAITING_NUM=BaseConfig.WAITING_NUM,
+                  DRAW_BACKEND=args.backend,
+                  DRAW_PARALLELISM=args.parallelism,
+                  DRAW_ROOT_SEED=str(args.seed))
+
+with app.app_context():
+    start = time.perf_counter()
+    dataset = generate_dataset()
+    print(f'generated {dataset} in {time.perf_counter() - start:.1f} s')
+
+    result = {
+        'commit': git_commit(),
+        'database': db.engine.dialect.name,
+        'backend': args.backend,
+        'parallelism': args.parallelism,
+        'dataset': dataset,
+        'draw_one': bench_draw_one(0),
+        'draw_all_at_index': bench_draw_all(1),
+        'phases': bench_phases(2),
+    }
+
+total = sum(run['seconds'] for run in result['draw_one'])
+print(f'draw_one: {total:.3f} s for {len(result["draw_one"])} lotteries, '
+      f'{max(run["queries"] for run in result["draw_one"])} queries at most')
+print(f'draw_all_at_index: {result["draw_all_at_index"]["seconds"]:.3f} s, '
+      f'{result["draw_all_at_index"]["queries"]} queries')
+for phase in ('load', 'draw', 'write'):
+    print(f'{phase}: {sum(run[phase] for run in result["phases"]):.3f} s')
+
+if args.output:
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+#
+# sampler benchmark
+#
+# Compare weighted sampling without replacement used by the draw:
+#   legacy:    numpy.random.choice over a list of objects, followed by
+#              `application in winner_apps` for every application
+#              (draw_one_normal_users before the array based engine)
+#   choice:    numpy.random.choice(..., replace=False, p=...) over indices
+#   priority:  api.draw_engine.weighted_sample (Efraimidis-Spirakis keys)
+#
+# Usage: python benchmarks/sampler.py [-k 85] [-r 20] [-n 1000 10000 100000]
+
+import sys
+import os
+sys.path.append(os.getcwd())  # noqa: E402
+import argparse  # noqa: E402
+import timeit  # noqa: E402
+import numpy as np  # noqa: E402
+from api.draw_engine import (  # noqa: E402
+    calc_advantages,
+    calc_probabilities,
+    weighted_sample
+)
+
+parser = argparse.ArgumentParser(
+    description='Benchmark weighted sampling of the draw')
+parser.add_argument("-n", "--sizes", type=int, nargs='+',
+                    default=[1000, 10000, 100000],
+                    help="numbers of applications")
+parser.add_argument("-k", "--winners", type=int, default=85,
+                    help="number of winners (WINNERS_NUM)")
+parser.add_argument("-r", "--repeat", type=int, default=20,
+                    help="number of runs for each case")
+args = parser.parse_args()
+
+rng = np.random.default_rng(0)
+
+
+def make_advantages(n):
+    """advantages of users who lost 0-3 times and won 0-1 times"""
+    return calc_advantages(rng.integers(0, 2, n),
+                           rng.integers(0, 4, n),
+                           rng.integers(0, 3, n))
+
+
+def sample_by_legacy(advantages, k):
+    applications = [object() for _ in range(len(advantages))]
+    winner_apps = list(np.random.choice(applications, k, replace=False,
+                                        p=calc_probabilities(advantages)))
+    return [application in winner_apps for application in applications]
+
+
+def sample_by_choice(advantages, k):
+    indices = np.arange(len(advantages))
+    return np.random.choice(indices, k, replace=False,
+                            p=calc_probabilities(advantages))
+
+
+def sample_by_priority(advantages, k):
+    return weighted_sample(advantages, k, rng)
+
+
+samplers = (sample_by_legacy, sample_by_choice, sample_by_priority)
+
+print(f'{"n":>8} {"legacy [ms]":>12} {"choice [ms]":>12} '
+      f'{"priority [ms]":>14} {"speedup":>8}')
+for n in args.sizes:
+    advantages = make_advantages(n)
+    k = min(args.winners, n)
+    results = []
+    for sampler in samplers:
+        seconds = min(timeit.repeat(lambda: sampler(advantages, k),
+                                    number=1, repeat=args.repeat))
+        results.append(seconds * 1000)
+    legacy_ms, choice_ms, priority_ms = results
+    print(f'{n:>8} {legacy_ms:>12.3f} {choice_ms:>12.3f} '
+          f'{priority_ms:>14.3f} {legacy_ms / priority_ms:>7.1f}x')
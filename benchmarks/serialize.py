@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+#
+# serialization benchmark
+#
+# Compare the CPU time per response of the hot list endpoints between
+#   schema: marshmallow schema + jsonify (the reference)
+#   fast:   api.fast_json functions + orjson (or json if not installed),
+#           with classrooms from api.catalog
+# on the initial classrooms and lotteries, with synthetic users who
+# applied to one lottery of each index and a draw of every lottery.
+#
+# Usage: python benchmarks/serialize.py [-u 3000] [-n 200] [-o result.json]
+
+import sys
+import os
+sys.path.append(os.getcwd())  # noqa: E402
+import argparse  # noqa: E402
+import json  # noqa: E402
+import time  # noqa: E402
+import numpy as np  # noqa: E402
+
+parser = argparse.ArgumentParser(
+    description='Benchmark serialization of the list endpoints')
+parser.add_argument("-u", "--users", type=int, default=3000,
+                    help="number of users")
+parser.add_argument("-n", "--repeat", type=int, default=200,
+                    help="number of responses made for each endpoint")
+parser.add_argument("--seed", type=int, default=0, help="random seed")
+parser.add_argument("-o", "--output", type=str,
+                    help="write the results into this JSON file")
+args = parser.parse_args()
+
+os.environ['FLASK_CONFIGURATION'] = 'testing'
+from flask import jsonify  # noqa: E402
+from api.app import create_app, generate  # noqa: E402
+from api.models import User, Lottery, Classroom, Application, db  # noqa
+from api.draw import draw_one  # noqa: E402
+from api.schemas import (  # noqa: E402
+    classrooms_schema,
+    lotteries_schema,
+    applications_schema
+)
+from api import fast_json  # noqa: E402
+from api.catalog import get_classroom_catalog  # noqa: E402
+from api.time_management import get_current_datetime  # noqa: E402
+
+rng = np.random.default_rng(args.seed)
+
+
+def generate_dataset():
+    """users applying to a random lottery of each index, all drawn"""
+    db.drop_all()
+    db.create_all()
+    generate()
+
+    first_id = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+    db.session.bulk_insert_mappings(User, [
+        {'id': first_id + i, 'public_id': 10 ** 7 + i,
+         'secret_id': f'benchmark{i}', 'authority': 'normal',
+         'kind': 'student', 'win_count': 0, 'lose_count': 0,
+         'waiting_count': 0}
+        for i in range(args.users)])
+
+    today = get_current_datetime().date()
+    applications = []
+    for index in range(len(app.config['TIMEPOINTS'])):
+        lottery_ids = [lottery.id for lottery
+                       in Lottery.query.filter_by(index=index)]
+        if not lottery_ids:
+            continue
+        for user_id, lottery in zip(
+                range(first_id, first_id + args.users),
+                rng.choice(lottery_ids, size=args.users).tolist()):
+            applications.append({'lottery_id': lottery, 'user_id': user_id,
+                                 'status': 'pending', 'created_on': today})
+    db.session.bulk_insert_mappings(Application, applications)
+    db.session.commit()
+
+    for lottery in Lottery.query.all():
+        draw_one(lottery)
+    return first_id
+
+
+def measure(make_response):
+    """CPU seconds per response"""
+    start = time.process_time()
+    for _ in range(args.repeat):
+        make_response().get_data()
+        db.session.expire_all()
+    return (time.process_time() - start) / args.repeat
+
+
+app = create_app()
+app.config.update(SQLALCHEMY_DATABASE_URI='sqlite://')
+
+with app.test_request_context():
+    user_id = generate_dataset()
+    endpoints = {
+        '/classrooms': (
+            lambda: jsonify(classrooms_schema.dump(
+                Classroom.query.all())[0]),
+            lambda: fast_json.json_response(fast_json.classrooms_to_list(
+                get_classroom_catalog().classrooms))),
+        '/lotteries': (
+            lambda: jsonify(lotteries_schema.dump(Lottery.query.all())[0]),
+            lambda: fast_json.json_response(fast_json.lotteries_to_list(
+                Lottery.query.all()))),
+        '/applications': (
+            lambda: jsonify(applications_schema.dump(
+                Application.query.filter_by(user_id=user_id).all())[0]),
+            lambda: fast_json.json_response(fast_json.applications_to_list(
+                Application.query.filter_by(user_id=user_id).all()))),
+    }
+
+    results = []
+    for path, (schema_response, fast_response) in endpoints.items():
+        schema_seconds = measure(schema_response)
+        fast_seconds = measure(fast_response)
+        results.append({'path': path,
+                        'schema_ms': schema_seconds * 1000,
+                        'fast_ms': fast_seconds * 1000,
+                        'saved_ms': (schema_seconds - fast_seconds) * 1000})
+
+encoder = 'orjson' if fast_json.orjson is not None else 'json'
+print(f'{args.users} users, {args.repeat} responses each, encoder: {encoder}')
+print(f'{"path":<14} {"schema ms":>10} {"fast ms":>10} {"saved ms":>10}')
+for result in results:
+    print(f'{result["path"]:<14} {result["schema_ms"]:>10.3f} '
+          f'{result["fast_ms"]:>10.3f} {result["saved_ms"]:>10.3f}')
+
+if args.output:
+    with open(args.output, 'w') as f:
+        json.dump({'encoder': encoder, 'results': results}, f, indent=2)
@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+#
+# draw simulator
+#
+# Run the draws of one festival day (len(TIMEPOINTS) rounds) over a
+# synthetic population many times, without the database, and report
+# how the wins are spread for each GroupAdvantage policy and each base
+# of the advantage curve (3 ** (lose + waiting / 2 - win) in the API).
+#
+# The population consists of parties of 1-4 users. Each round, every
+# party applies together to one lottery with the probability -a, and
+# the lottery is chosen by its popularity (Zipf with the exponent -s).
+# Counters of users carry over to the next round as in the API.
+#
+# Trials are run in batches as arrays shaped (trials, parties), with
+# the draw math of api.draw_engine (calc_advantages, GroupAdvantage and
+# priority_keys). By default the lotteries of all trials are drawn at
+# once with the rules of api.draw_engine.draw_frame: in each phase
+# (winners, then the waiting list) groups are decided first by the
+# bounded pass of sample_groups, then users not belonging to a group
+# fill the rest. Totals reachable with the groups left are looked up in
+# a table indexed by the numbers of groups of 2, 3 and 4 users, instead
+# of the bitsets of sample_groups. Random numbers are drawn in another
+# order, so results follow the same distribution as draw_frame but are
+# not the same draws.
+#
+# --sql cuts the order of weighted random keys with WINNERS_NUM and
+# WAITING_NUM instead, as the SQL backend (api.draw_sql) does.
+# --exact runs draw_frame for each lottery. It is much slower, so use it
+# with a small number of trials to check the vectorized results.
+#
+# Usage: python benchmarks/simulate.py [-t 100000] [-u 2000]
+#            [-p minimum average rep] [-b 3] [--sql | --exact]
+#            [-o result.json]
+
+import sys
+import os
+sys.path.append(os.getcwd())  # noqa: E402
+import argparse  # noqa: E402
+import json  # noqa: E402
+import time  # noqa: E402
+import numpy as np  # noqa: E402
+from api.config import BaseConfig  # noqa: E402
+from api.draw_engine import (  # noqa: E402
+    GroupAdvantage,
+    DrawFrame,
+    WON,
+    WAITING,
+    LOSE,
+    calc_advantages,
+    draw_frame,
+    priority_keys,
+    statuses_from_ranks
+)
+
+parser = argparse.ArgumentParser(
+    description='Simulate draws of one festival day')
+parser.add_argument("-t", "--trials", type=int, default=10000,
+                    help="number of simulated days")
+parser.add_argument("-u", "--users", type=int, default=2000,
+                    help="number of users")
+parser.add_argument("-l", "--lotteries", type=int, default=8,
+                    help="number of lotteries in each round")
+parser.add_argument("-r", "--rounds", type=int,
+                    default=len(BaseConfig.TIMEPOINTS),
+                    help="number of rounds (time points) in a day")
+parser.add_argument("-w", "--winners", type=int,
+                    default=BaseConfig.WINNERS_NUM, help="WINNERS_NUM")
+parser.add_argument("-k", "--waiting", type=int,
+                    default=BaseConfig.WAITING_NUM, help="WAITING_NUM")
+parser.add_argument("-a", "--apply", type=float, default=0.8,
+                    help="probability that a party applies in a round")
+parser.add_argument("-s", "--skew", type=float, default=1.0,
+                    help="Zipf exponent of the popularity of lotteries")
+parser.add_argument("-g", "--party-sizes", type=float, nargs=4,
+                    default=[0.55, 0.25, 0.12, 0.08],
+                    help="share of parties of 1, 2, 3 and 4 users")
+parser.add_argument("-p", "--policies", nargs='+',
+                    default=['minimum', 'average', 'rep'],
+                    choices=['minimum', 'average', 'rep'],
+                    help="GroupAdvantage policies to compare")
+parser.add_argument("-b", "--bases", type=float, nargs='+', default=[3.0],
+                    help="bases of the advantage curve to compare")
+parser.add_argument("--batch", type=int, default=1000,
+                    help="number of trials computed at once")
+mode = parser.add_mutually_exclusive_group()
+mode.add_argument("--sql", action='store_true',
+                  help="cut the order of keys as the SQL backend does")
+mode.add_argument("--exact", action='store_true',
+                  help="draw each lottery with draw_frame")
+parser.add_argument("--seed", type=int, default=0, help="random seed")
+parser.add_argument("-o", "--output", type=str,
+                    help="write the results into this JSON file")
+args = parser.parse_args()
+
+
+def make_population(rng):
+    """parties of the users, the members of a party are contiguous
+        Return:
+          party_of_user(numpy.ndarray): party number of each user
+          sizes(numpy.ndarray): number of users in each party
+          is_rep(numpy.ndarray): whether each user is the rep of the party
+    """
+    shares = np.array(args.party_sizes) / sum(args.party_sizes)
+    sizes = []
+    while sum(sizes) < args.users:
+        sizes.append(rng.choice(4, p=shares) + 1)
+    sizes = np.array(sizes)
+    sizes[-1] -= sum(sizes) - args.users
+    party_of_user = np.repeat(np.arange(len(sizes)), sizes)
+    is_rep = np.r_[True, party_of_user[1:] != party_of_user[:-1]]
+    return party_of_user, sizes, is_rep
+
+
+def party_advantages(policy, advantages, party_of_user, is_rep):
+    """advantage of each party by the policy, shaped (trials, parties)
+        trials are flattened so that GroupAdvantage can be used as it is
+    """
+    trials, n_users = advantages.shape
+    n_parties = party_of_user[-1] + 1
+    groups = (party_of_user + n_parties * np.arange(trials)[:, None]).ravel()
+    return policy(advantages.ravel(), groups,
+                  np.tile(is_rep, trials)).reshape(trials, n_parties)
+
+
+# sizes of groups, as made by make_population
+GROUP_SIZES = np.arange(2, 5)
+
+
+def reach_table(upper):
+    """totals up to `upper` reachable with groups of GROUP_SIZES
+        Return:
+          cumulative(numpy.ndarray): cumulative[a, b, c, t] is the number
+              of reachable totals <= t with at most a, b and c groups
+              of each size. more groups than `upper // size` reach nothing
+              new, so counts are capped with `caps`
+          most(numpy.ndarray): the largest reachable total for the counts
+          caps(numpy.ndarray): the largest count of groups of each size
+    """
+    caps = upper // GROUP_SIZES
+    reach = np.zeros(tuple(caps + 1) + (upper + 1,), dtype=bool)
+    reach[0, 0, 0, 0] = True
+    for axis, size in enumerate(GROUP_SIZES):
+        for count in range(1, caps[axis] + 1):
+            previous = np.take(reach, count - 1, axis=axis)
+            current = previous.copy()
+            current[..., size:] |= previous[..., :-size]
+            index = [slice(None)] * 3
+            index[axis] = count
+            reach[tuple(index)] = current
+    most = upper - np.argmax(reach[..., ::-1], axis=-1)
+    return np.cumsum(reach, axis=-1), most, caps
+
+
+def reaches(table, counts, lower, upper):
+    """whether groups of `counts` reach a total in [lower, upper],
+        as api.draw_engine._reaches does for each cell
+        Args:
+          counts(numpy.ndarray): groups of each size, shaped (3, cells)
+    """
+    cumulative, _, caps = table
+    limit = cumulative.shape[-1] - 1
+    lower = np.maximum(lower, 0)
+    counts = tuple(np.minimum(counts, caps[:, None]))
+    high = cumulative[counts + (np.clip(upper, 0, limit),)]
+    low = np.where(lower > 0, cumulative[
+        counts + (np.clip(lower - 1, 0, limit),)], 0)
+    return (upper >= lower) & (lower <= limit) & (high > low)
+
+
+def order_in_cells(cell, keys, first=None):
+    """indices sorted by cell, then with `first` ones first, then by keys
+        in descending order. same as np.lexsort((-keys, ~first, cell)),
+        with a stable sort of integers over the order of keys, which is
+        faster
+    """
+    order = np.argsort(-keys)
+    cell = cell * 2 if first is None else cell * 2 + ~first
+    return order[np.argsort(cell[order], kind='stable')]
+
+
+def positions(cell, n_cells):
+    """position of each item in its cell, for items sorted by cell"""
+    counts = np.bincount(cell, minlength=n_cells)
+    return np.arange(len(cell)) - (np.cumsum(counts) - counts)[cell]
+
+
+def draw_phase(cell, sizes, advantages, n_cells, num, table, rng):
+    """choose `num` applications in each cell (a lottery of a trial),
+        as api.draw_engine._draw_phase does
+        Args:
+          cell(numpy.ndarray): cell of each party in the target
+          sizes(numpy.ndarray): number of users in each party
+          advantages(numpy.ndarray): advantage of each party
+        Return:
+          chosen(numpy.ndarray): whether each party is chosen
+    """
+    chosen = np.zeros(len(cell), dtype=bool)
+    if num <= 0 or len(cell) == 0:
+        return chosen
+
+    is_group = sizes > 1
+    total_advantages = np.bincount(cell, advantages * sizes,
+                                   minlength=n_cells)
+    lower = num - np.bincount(cell[~is_group], minlength=n_cells)
+    upper = np.full(n_cells, num)
+
+    # groups in the order of sample_groups: won the coin toss first,
+    # then by the weighted random keys
+    groups = np.flatnonzero(is_group)
+    probabilities = (advantages[groups] /
+                     total_advantages[cell[groups]] * num)
+    wanted = rng.random(len(groups)) < probabilities
+    keys = priority_keys(probabilities, rng)
+    order = order_in_cells(cell[groups], keys, wanted)
+    groups, wanted = groups[order], wanted[order]
+    group_cell, group_sizes = cell[groups], sizes[groups]
+
+    # groups of each size in each cell, and after each group in its cell
+    one_hot = group_sizes == GROUP_SIZES[:, None]
+    counts = np.stack([np.bincount(group_cell[row], minlength=n_cells)
+                       for row in one_hot])
+    after = counts[:, group_cell] - np.cumsum(one_hot, axis=1) + \
+        (np.cumsum(counts, axis=1) - counts)[:, group_cell]
+
+    # fill as many as possible if the range can't be reached
+    unreachable = ~reaches(table, counts, lower, upper)
+    lower[unreachable] = table[1][tuple(np.minimum(
+        counts[:, unreachable], table[2][:, None]))]
+
+    total = np.zeros(n_cells, dtype=int)
+    position = positions(group_cell, n_cells)
+    by_position = np.argsort(position, kind='stable')
+    ends = np.cumsum(np.bincount(position)) if len(position) else []
+    for at in np.split(by_position, ends[:-1]):
+        at_cell, size = group_cell[at], group_sizes[at]
+        rest = after[:, at]
+        room = (lower[at_cell] - total[at_cell], num - total[at_cell])
+        can_include = reaches(table, rest, room[0] - size, room[1] - size)
+        can_exclude = reaches(table, rest, *room)
+        won = (wanted[at] & can_include) | ~can_exclude
+        total[at_cell[won]] += size[won]
+        chosen[groups[at[won]]] = True
+
+    # users not belonging to a group fill the rest by weighted sampling
+    normals = np.flatnonzero(~is_group)
+    keys = priority_keys(advantages[normals], rng)
+    normals = normals[order_in_cells(cell[normals], keys)]
+    chosen[normals[positions(cell[normals], n_cells) <
+                   (num - total)[cell[normals]]]] = True
+    return chosen
+
+
+def draw_round_engine(advantages, applying, lotteries, sizes, tables,
+                      rng):
+    """statuses of parties, drawing all lotteries of all trials at once
+        with the rules of draw_frame
+        Args:
+          advantages(numpy.ndarray): advantage of each party
+          tables((tuple, tuple)): `reach_table` of WINNERS_NUM and
+                                  WAITING_NUM
+    """
+    trial, party = np.nonzero(applying)
+    cell = trial * args.lotteries + lotteries[trial, party]
+    n_cells = len(applying) * args.lotteries
+    party_sizes, party_advantages = sizes[party], advantages[trial, party]
+
+    won = draw_phase(cell, party_sizes, party_advantages, n_cells,
+                     args.winners, tables[0], rng)
+    waiting = np.zeros_like(won)
+    rest = ~won
+    waiting[rest] = draw_phase(cell[rest], party_sizes[rest],
+                               party_advantages[rest], n_cells,
+                               args.waiting, tables[1], rng)
+
+    statuses = np.full(applying.shape, LOSE)
+    statuses[trial, party] = np.select([won, waiting], [WON, WAITING], LOSE)
+    return statuses
+
+
+def draw_round(keys, lotteries, sizes):
+    """statuses of parties, from the order of keys in each lottery,
+        cut as the SQL backend does
+        Args:
+          keys(numpy.ndarray): priority keys, -inf for parties not applying
+          lotteries(numpy.ndarray): lottery of each party, shaped as keys
+          sizes(numpy.ndarray): number of users in each party
+    """
+    order = np.lexsort((-keys, lotteries), axis=-1)
+    ordered_lotteries = np.take_along_axis(lotteries, order, axis=-1)
+    ordered_sizes = sizes[order]
+    ends = np.cumsum(ordered_sizes, axis=-1)
+    first = np.ones_like(ordered_lotteries, dtype=bool)
+    first[:, 1:] = ordered_lotteries[:, 1:] != ordered_lotteries[:, :-1]
+    starts = np.maximum.accumulate(
+        np.where(first, ends - ordered_sizes, 0), axis=-1)
+    statuses = np.empty_like(order)
+    np.put_along_axis(
+        statuses, order,
+        statuses_from_ranks(ends - starts, args.winners, args.waiting),
+        axis=-1)
+    return statuses
+
+
+def draw_round_exact(advantages, applying, lotteries,
+                     party_of_user, sizes, policy, rng):
+    """statuses of parties, drawing each lottery with draw_frame
+    """
+    statuses = np.full(applying.shape, LOSE)
+    user_ids = np.arange(len(party_of_user))
+    for trial in range(len(applying)):
+        for lottery in range(args.lotteries):
+            parties = np.flatnonzero(applying[trial] &
+                                     (lotteries[trial] == lottery))
+            if len(parties) == 0:
+                continue
+            users = user_ids[np.isin(party_of_user, parties)]
+            in_group = sizes[party_of_user[users]] > 1
+            groups = np.full(len(users), -1)
+            groups[in_group] = np.unique(party_of_user[users][in_group],
+                                         return_inverse=True)[1]
+            is_rep = np.r_[True, party_of_user[users][1:] !=
+                           party_of_user[users][:-1]] & in_group
+            frame = DrawFrame(users, users, is_rep, groups,
+                              advantages[trial, users])
+            ranks = draw_frame(frame, args.winners, args.waiting,
+                               policy, rng)
+            user_statuses = statuses_from_ranks(ranks, args.winners,
+                                                args.waiting)
+            statuses[trial, party_of_user[users]] = user_statuses
+    return statuses
+
+
+def simulate(policy, base, population, popularity, tables, rng):
+    """simulate days in a batch
+        Return:
+          applications(numpy.ndarray): applications of each user
+          wins(numpy.ndarray): wins of each user, shaped (trials, users)
+    """
+    party_of_user, sizes, is_rep = population
+    trials = args.batch
+    counts = np.zeros((3, trials, len(party_of_user)), dtype=int)
+    applications = np.zeros((trials, len(party_of_user)), dtype=int)
+
+    for _ in range(args.rounds):
+        advantages = calc_advantages(*counts, base=base)
+        applying = rng.random((trials, len(sizes))) < args.apply
+        lotteries = rng.choice(args.lotteries, size=applying.shape,
+                               p=popularity)
+        if args.exact:
+            statuses = draw_round_exact(advantages, applying, lotteries,
+                                        party_of_user, sizes, policy, rng)
+        elif args.sql:
+            keys = priority_keys(party_advantages(
+                policy, advantages, party_of_user, is_rep), rng)
+            keys[~applying] = -np.inf
+            lotteries[~applying] = args.lotteries
+            statuses = draw_round(keys, lotteries, sizes)
+        else:
+            statuses = draw_round_engine(
+                party_advantages(policy, advantages, party_of_user, is_rep),
+                applying, lotteries, sizes, tables, rng)
+
+        applied = applying[:, party_of_user]
+        user_statuses = statuses[:, party_of_user]
+        for counter, status in enumerate((WON, LOSE, WAITING)):
+            counts[counter] += applied & (user_statuses == status)
+        applications += applied
+    return applications, counts[0]
+
+
+def summarize(applications, wins, party_of_user, sizes):
+    """statistics of the wins"""
+    user_sizes = sizes[party_of_user]
+    won_any = wins > 0
+    # probability to win at least once for each user, over the trials
+    user_rates = won_any.mean(axis=0)
+    return {
+        'wins_per_application': float(wins.sum() / applications.sum()),
+        'won_at_least_once': float(won_any.mean()),
+        'wins_distribution': [float((wins == n).mean())
+                              for n in range(args.rounds + 1)],
+        'won_at_least_once_by_party_size': {
+            int(size): float(won_any[:, user_sizes == size].mean())
+            for size in np.unique(user_sizes)},
+        'user_rate_percentiles': {
+            str(q): float(np.percentile(user_rates, q))
+            for q in (0, 10, 50, 90, 100)},
+    }
+
+
+rng = np.random.default_rng(args.seed)
+population = make_population(rng)
+popularity = 1 / np.arange(1, args.lotteries + 1) ** args.skew
+popularity /= popularity.sum()
+tables = (reach_table(args.winners), reach_table(args.waiting))
+args.batch = min(args.batch, args.trials)
+n_batches = -(-args.trials // args.batch)
+args.trials = n_batches * args.batch
+
+results = []
+for policy_name in args.policies:
+    policy = getattr(GroupAdvantage, policy_name)
+    for base in args.bases:
+        start = time.perf_counter()
+        batches = [simulate(policy, base, population, popularity, tables,
+                            rng)
+                   for _ in range(n_batches)]
+        applications, wins = (np.concatenate(arrays)
+                              for arrays in zip(*batches))
+        result = {'policy': policy_name, 'base': base,
+                  'trials': args.trials,
+                  'seconds': time.perf_counter() - start}
+        result.update(summarize(applications, wins, *population[:2]))
+        results.append(result)
+
+print(f'{args.trials} days, {args.users} users, '
+      f'{len(population[1])} parties, {args.lotteries} lotteries, '
+      f'{args.rounds} rounds' + (' (exact)' if args.exact else
+                                 ' (sql)' if args.sql else ''))
+print(f'{"policy":>8} {"base":>5} {"win/app":>8} {"won>=1":>7} '
+      f'{"size1":>6} {"size2":>6} {"size3":>6} {"size4":>6} '
+      f'{"p10":>6} {"p50":>6} {"p90":>6} {"sec":>7}')
+for result in results:
+    by_size = result['won_at_least_once_by_party_size']
+    rates = result['user_rate_percentiles']
+    print(f'{result["policy"]:>8} {result["base"]:>5.1f} '
+          f'{result["wins_per_application"]:>8.3f} '
+          f'{result["won_at_least_once"]:>7.3f} ' +
+          ' '.join(f'{by_size.get(size, float("nan")):>6.3f}'
+                   for size in range(1, 5)) +
+          f' {rates["10"]:>6.3f} {rates["50"]:>6.3f} {rates["90"]:>6.3f}'
+          f' {result["seconds"]:>7.1f}')
+
+if args.output:
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
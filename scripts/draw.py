@@ -8,6 +8,7 @@
 
 import json
 import sys
+import time
 import argparse
 from urllib.request import Request, urlopen
 from urllib.error import HTTPError
@@ -23,6 +24,8 @@ parser.add_argument("-p", "--protocol", type=str,
                     default="http", help="The protocol to use")
 parser.add_argument("-y", "--yes", action='store_true',
                     help="Don't confirm before drawing")
+parser.add_argument("-i", "--interval", type=float, default=2.0,
+                    help="Seconds between polls of the draw job")
 args = parser.parse_args()
 
 with open(args.list, 'r') as f:
@@ -33,13 +36,21 @@ admin_ids = next(cred for cred in id_list if cred['authority'] == 'admin')
 
 
 def post_json(path, data=None, token=None):
+    return request_json('POST', path, data, token)
+
+
+def get_json(path, token=None):
+    return request_json('GET', path, None, token)
+
+
+def request_json(method, path, data=None, token=None):
     headers = {"Content-Type": "application/json"}
     if token:
         headers['Authorization'] = 'Bearer ' + token
     json_data = json.dumps(data).encode("utf-8") if data else None
     url = '{}://{}/{}'.format(args.protocol, args.host, path)
     request = Request(url, data=json_data,
-                      headers=headers, method='POST')
+                      headers=headers, method=method)
     try:
         response = urlopen(request)
     except HTTPError as e:
@@ -79,5 +90,20 @@ if not args.yes:
 # POST /draw_all
 response_draw = post_json('draw_all', None, token)
 
+# When the server queues draws, poll the job until it finishes
+# (the job contains 'status', while the list of winners does not)
+if isinstance(response_draw, dict) and 'status' in response_draw:
+    job_id = response_draw['id']
+    while response_draw['status'] in ('queued', 'running'):
+        print('Draw job {}: {} ({}/{})'.format(
+            job_id, response_draw['status'],
+            response_draw['progress'], response_draw['total']),
+            file=sys.stderr)
+        time.sleep(args.interval)
+        response_draw = get_json('draw_jobs/{}'.format(job_id), token)
+    if response_draw['status'] == 'failed':
+        print('Error: {}'.format(response_draw['error']), file=sys.stderr)
+        sys.exit(-1)
+
 # Print the result
 print(response_draw)
@@ -0,0 +1,59 @@
+import pytest
+
+from api.app import generate
+from api.catalog import get_classroom_catalog
+from api.models import Classroom, db
+from api.schemas import classroom_schema
+from api.utils import count_queries
+
+
+def test_classroom_catalog(client):
+    """test the catalog is the same as the classrooms in the DB
+        and can't be changed
+    """
+    with client.application.app_context():
+        catalog = get_classroom_catalog()
+        classrooms = Classroom.query.order_by(Classroom.id).all()
+        assert len(catalog) == len(classrooms)
+        for entry, classroom in zip(catalog.classrooms, classrooms):
+            assert entry._asdict() == classroom_schema.dump(classroom)[0]
+
+        with pytest.raises(TypeError):
+            catalog.by_id[0] = catalog.classrooms[0]
+        with pytest.raises(AttributeError):
+            catalog.classrooms[0].title = 'changed'
+
+
+def test_classroom_catalog_rebuilt(client):
+    """test the catalog is rebuilt by `generate`
+        1. delete classrooms from the DB
+        2. test: the catalog is kept
+        3. generate the DB again
+        4. test: the catalog is the new classrooms
+    """
+    with client.application.app_context():
+        catalog = get_classroom_catalog()
+        Classroom.query.delete()
+        db.session.commit()
+        assert get_classroom_catalog() is catalog
+
+        generate()
+        new_catalog = get_classroom_catalog()
+        assert new_catalog is not catalog
+        assert [entry.id for entry in new_catalog.classrooms] == \
+            [classroom.id for classroom
+             in Classroom.query.order_by(Classroom.id)]
+
+
+def test_list_classrooms_without_db(client):
+    """test classrooms are listed without querying the DB
+        target_url: /classrooms, /classrooms/<id>
+    """
+    client.get('/classrooms')  # the DB is initialized in the first request
+    with client.application.app_context():
+        with count_queries(db.engine) as statements:
+            resp = client.get('/classrooms')
+            assert resp.status_code == 200
+            resp = client.get(f'/classrooms/{resp.get_json()[0]["id"]}')
+            assert resp.status_code == 200
+    assert statements == []
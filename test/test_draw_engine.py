@@ -0,0 +1,249 @@
+import numpy as np
+
+from api.models import calc_advantage
+from api.draw_engine import (
+    GroupAdvantage,
+    DrawFrame,
+    WON,
+    WAITING,
+    LOSE,
+    calc_advantages,
+    draw_frame,
+    statuses_from_ranks,
+    sample_groups,
+    weighted_sample
+)
+
+
+def make_frame(groups):
+    """make a frame of applications with no win/lose history
+        groups (list of int): group size of each group
+            (1 means a user not belonging to a group)
+    """
+    rows = []
+    for size in groups:
+        rep_id = len(rows) + 1
+        for i in range(size):
+            app_id = len(rows) + 1
+            is_rep = size > 1 and i == 0
+            rep = rep_id if size > 1 and not is_rep else None
+            rows.append((app_id, app_id, is_rep, rep, 1.0, None, None))
+    return DrawFrame.from_rows(rows)
+
+
+def test_calc_advantages():
+    """test the advantage is the same as `calc_advantage`
+    """
+    win = np.array([0, 0, 1, 0, 2])
+    lose = np.array([0, 1, 1, 2, 1])
+    waiting = np.array([4, 0, 2, 1, 0])
+
+    expected = [1, 3, 3, 3 ** 2.5, 1]
+    assert np.allclose(calc_advantages(win, lose, waiting), expected)
+    assert np.allclose([calc_advantage(*counts)
+                        for counts in zip(win, lose, waiting)], expected)
+
+
+def test_frame_groups():
+    """test group numbers are assigned to reps and their members
+    """
+    frame = make_frame([1, 3, 1, 2])
+
+    assert frame.groups.tolist() == [-1, 0, 0, 0, -1, 1, 1]
+    assert frame.is_rep.tolist() == [False, True, False, False,
+                                     False, True, False]
+    assert frame.n_groups == 2
+
+
+def test_group_advantage():
+    """test each policy of `GroupAdvantage`
+    """
+    advantages = np.array([1., 9., 3., 27.])
+    groups = np.array([0, 0, 1, 1])
+    is_rep = np.array([False, True, True, False])
+
+    assert GroupAdvantage.minimum(advantages, groups, is_rep).tolist() == \
+        [1., 3.]
+    assert GroupAdvantage.average(advantages, groups, is_rep).tolist() == \
+        [5., 15.]
+    assert GroupAdvantage.rep(advantages, groups, is_rep).tolist() == \
+        [9., 3.]
+
+
+def test_recorded_group_advantage():
+    """test the group advantage recorded on the rep is preferred
+    """
+    frame = make_frame([1, 2, 2])
+    frame.rep_advantages[1] = 9.
+
+    advantages = frame.group_advantages(GroupAdvantage.average)
+    assert advantages.tolist() == [1., 9., 9., 1., 1.]
+
+
+def test_draw_frame():
+    """test numbers of winners and waiting applications,
+        and that members of a group share the result
+    """
+    frame = make_frame([1] * 10 + [2, 3, 2])
+
+    ranks = draw_frame(frame, 5, 3, GroupAdvantage.average,
+                       np.random.default_rng(0))
+    statuses = statuses_from_ranks(ranks, 5, 3)
+
+    assert (statuses == WON).sum() == 5
+    assert (statuses == WAITING).sum() == 3
+    assert (statuses == LOSE).sum() == len(frame) - 8
+    for group in range(frame.n_groups):
+        assert len(set(statuses[frame.groups == group])) == 1
+
+
+def test_draw_frame_ranks():
+    """test ranks make one order keeping groups together
+        and can be cut with other numbers
+    """
+    frame = make_frame([1] * 10 + [2, 3, 2])
+    ranks = draw_frame(frame, 5, 3, GroupAdvantage.average,
+                       np.random.default_rng(0))
+
+    # members of a group share the rank of the last member
+    for group in range(frame.n_groups):
+        group_ranks = ranks[frame.groups == group]
+        assert len(set(group_ranks.tolist())) == 1
+    ends = sorted(set(ranks.tolist()))
+    assert ends[-1] == len(frame)
+    sizes = np.diff([0] + ends)
+    assert sorted(sizes.tolist()) == [1] * 10 + [2, 2, 3]
+
+    # re-cut: nobody wins without seats, everybody with enough seats
+    assert (statuses_from_ranks(ranks, 0, 0) == LOSE).all()
+    assert (statuses_from_ranks(ranks, len(frame), 0) == WON).all()
+
+
+def test_draw_frame_unfilled_seats():
+    """test seats groups can't fill are not given to the next status
+        1. a group of 4 with 1 seat to win and 3 on the waiting list
+        2. groups of 4 and 2 users with 3 seats to win and 3 to wait
+        test: statuses cut from ranks are the ones of the draw
+    """
+    frame = make_frame([4])
+    ranks = draw_frame(frame, 1, 3, GroupAdvantage.average,
+                       np.random.default_rng(0))
+    assert (statuses_from_ranks(ranks, 1, 3) == LOSE).all()
+
+    frame = make_frame([1, 1, 4, 4])
+    ranks = draw_frame(frame, 3, 3, GroupAdvantage.average,
+                       np.random.default_rng(0))
+    statuses = statuses_from_ranks(ranks, 3, 3)
+    assert statuses.tolist() == [WON] * 2 + [LOSE] * 8
+
+
+def test_draw_frame_bounds():
+    """test the waiting list never exceeds its seats on random frames
+        and groups share their result
+    """
+    rng = np.random.default_rng(0)
+    for _ in range(2000):
+        frame = make_frame(rng.integers(1, 5, size=rng.integers(1, 8)))
+        winners_num, waiting_num = rng.integers(0, 6, size=2).tolist()
+        ranks = draw_frame(frame, winners_num, waiting_num,
+                           GroupAdvantage.average, rng)
+        statuses = statuses_from_ranks(ranks, winners_num, waiting_num)
+
+        assert (statuses == WON).sum() <= winners_num
+        assert (statuses == WAITING).sum() <= waiting_num
+        for group in range(frame.n_groups):
+            assert len(set(statuses[frame.groups == group])) == 1
+
+
+def staged_frame(groups, ranks):
+    """make a frame staged with the ranks, dropping ranks of 0 (cancelled)
+    """
+    frame = make_frame(groups)
+    keep = np.asarray(ranks) > 0
+    return DrawFrame(frame.application_ids[keep], frame.user_ids[keep],
+                     frame.is_rep[keep], frame.groups[keep],
+                     frame.advantages[keep], np.asarray(ranks)[keep])
+
+
+def test_staged_ranks_cancelled():
+    """test seats of cancelled applications are filled in the staged order
+        1. stage 5 users with 2 seats to win and 2 to wait, cancel a winner
+        2. test: the next users move up to the seats
+        3. stage a group next to a winner, cancel the winner
+        4. test: the group which doesn't fit in the seat stays behind
+    """
+    frame = staged_frame([1] * 5, [0, 2, 3, 4, 5])
+    statuses = statuses_from_ranks(frame.staged_ranks(2, 2), 2, 2)
+    assert statuses.tolist() == [WON, WON, WAITING, WAITING]
+
+    frame = staged_frame([1, 1, 2, 1], [0, 2, 4, 4, 5])
+    statuses = statuses_from_ranks(frame.staged_ranks(2, 2), 2, 2)
+    assert statuses.tolist() == [WON, WAITING, WAITING, LOSE]
+
+
+def test_sample_groups_exact():
+    """test groups are chosen to fill the range whenever it is possible
+        groups of 2, 2, 3 and 3 can hold exactly 5 applications
+        only with one group of 2 and one group of 3
+    """
+    rng = np.random.default_rng(0)
+    sizes = np.array([2, 2, 3, 3])
+    probabilities = np.full(4, 0.5)
+
+    for _ in range(100):
+        won = sample_groups(probabilities, sizes, 5, 5, rng)
+        assert sizes[won].sum() == 5
+
+
+def test_sample_groups_unreachable():
+    """test as many applications as possible are chosen
+        when the range can't be filled
+    """
+    rng = np.random.default_rng(0)
+    sizes = np.array([3, 3, 4])
+    probabilities = np.ones(3)
+
+    for _ in range(100):
+        won = sample_groups(probabilities, sizes, 5, 5, rng)
+        assert sizes[won].sum() == 4
+
+    won = sample_groups(probabilities, sizes, 2, 2, rng)
+    assert not won.any()
+
+
+def test_sample_groups_follows_probabilities():
+    """test groups that are sure to win or lose keep their result
+        while the range allows it
+    """
+    sizes = np.array([2, 2, 2, 2])
+    probabilities = np.array([1., 1., 0., 0.])
+
+    won = sample_groups(probabilities, sizes, 0, 4,
+                        np.random.default_rng(0))
+    assert won.tolist() == [True, True, False, False]
+
+
+def test_weighted_sample():
+    """test k distinct items are chosen, and all when k >= n
+    """
+    rng = np.random.default_rng(0)
+    weights = np.arange(1, 101, dtype=float)
+
+    chosen = weighted_sample(weights, 10, rng)
+    assert len(chosen) == 10
+    assert len(set(chosen.tolist())) == 10
+
+    assert sorted(weighted_sample(weights, 200, rng).tolist()) == \
+        list(range(100))
+    assert len(weighted_sample(weights, 0, rng)) == 0
+
+
+def test_weighted_sample_weights():
+    """test an item with large weight is chosen more often
+    """
+    rng = np.random.default_rng(0)
+    weights = np.ones(10)
+    weights[0] = 27
+
+    wins = sum(0 in weighted_sample(weights, 1, rng) for _ in range(1000))
+    assert wins > 600   # expected 27 / 36 = 75%
@@ -0,0 +1,72 @@
+import threading
+
+from utils import add_db, users2application
+
+from api.models import Lottery, User, DrawRun
+from api.draw import draw_one
+from api.draw_lock import lottery_lock, _file_lock
+
+
+def assert_blocks(lock, acquire_another):
+    """test another thread waits until `lock` is released
+        Args:
+          lock: the lock held in this thread
+          acquire_another(function): acquires the lock in another thread,
+                                     taking the function to call in it
+    """
+    acquired = threading.Event()
+
+    def acquire():
+        acquire_another(acquired.set)
+
+    with lock:
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        assert not acquired.wait(0.2)
+    assert acquired.wait(5)
+    thread.join()
+
+
+def test_lottery_lock(client):
+    """test a lottery is locked by one thread at a time
+    """
+    with client.application.app_context():
+        first, second = Lottery.query.limit(2).all()
+
+        def acquire_first(callback):
+            with client.application.app_context():
+                with lottery_lock(first):
+                    callback()
+        assert_blocks(lottery_lock(first), acquire_first)
+
+        with lottery_lock(first):
+            with lottery_lock(second):
+                pass
+
+
+def test_file_lock(tmp_path):
+    """test the file lock excludes other open files of the same path
+    """
+    path = str(tmp_path / 'draw.lock')
+
+    def acquire(callback):
+        with _file_lock(path):
+            callback()
+    assert_blocks(_file_lock(path), acquire)
+
+
+def test_draw_idempotent(client):
+    """attempt to draw a lottery twice
+        test: the second draw returns the same winners without drawing
+    """
+    with client.application.app_context():
+        target_lottery = Lottery.query.get(1)
+        users = User.query.filter_by(authority='normal').all()
+        add_db(users2application(users, target_lottery))
+
+        first = {winner.id for winner in draw_one(target_lottery)}
+        second = {winner.id for winner in draw_one(target_lottery)}
+        assert first == second
+        assert len(first) == client.application.config['WINNERS_NUM']
+        assert DrawRun.query.count() == 1
+        assert sum(user.win_count for user in User.query.all()) == len(first)
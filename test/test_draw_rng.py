@@ -0,0 +1,70 @@
+import datetime
+
+from utils import add_db, users2application
+
+from api.models import Lottery, User, DrawSeed
+from api.draw import group_advantage_calculation
+from api.draw_engine import load_frame, draw_frame
+from api.draw_rng import get_root_entropy, lottery_rng
+from api.time_management import get_current_datetime
+
+
+def test_root_seed(client):
+    """test the root seed is recorded once a day
+    """
+    with client.application.app_context():
+        entropy = get_root_entropy()
+        assert get_root_entropy() == entropy
+        assert DrawSeed.query.count() == 1
+
+        tomorrow = get_current_datetime().date() + datetime.timedelta(days=1)
+        assert get_root_entropy(tomorrow) != entropy
+        assert DrawSeed.query.count() == 2
+
+
+def test_root_seed_not_recorded(client):
+    """test a seed isn't recorded with record=False,
+        and the recorded seed is used once it is
+    """
+    with client.application.app_context():
+        get_root_entropy(record=False)
+        assert DrawSeed.query.count() == 0
+
+        entropy = get_root_entropy()
+        assert get_root_entropy(record=False) == entropy
+
+
+def test_root_seed_config(client):
+    """test DRAW_ROOT_SEED is used instead of the recorded seed
+    """
+    client.application.config['DRAW_ROOT_SEED'] = '42'
+    with client.application.app_context():
+        date = datetime.date(2020, 9, 20)
+        assert get_root_entropy(date) == [42, date.toordinal()]
+        assert DrawSeed.query.count() == 0
+
+
+def test_lottery_rng(client):
+    """test each lottery has its own stream which can be reproduced
+    """
+    with client.application.app_context():
+        first, second = Lottery.query.limit(2).all()
+
+        numbers = lottery_rng(first).random(5)
+        assert (lottery_rng(first).random(5) == numbers).all()
+        assert (lottery_rng(second).random(5) != numbers).all()
+
+
+def test_draw_reproducible(client):
+    """test the draw gives the same ranks with the stream of the lottery
+    """
+    with client.application.app_context():
+        target_lottery = Lottery.query.first()
+        users = User.query.filter_by(authority='normal').all()
+        add_db(users2application(users, target_lottery))
+
+        frame = load_frame(target_lottery)
+        ranks = [draw_frame(frame, 5, 3, group_advantage_calculation,
+                            lottery_rng(target_lottery)).tolist()
+                 for _ in range(2)]
+        assert ranks[0] == ranks[1]
@@ -0,0 +1,73 @@
+import json
+from unittest import mock
+
+from utils import (
+    admin,
+    add_db,
+    draw,
+    get_token,
+    users2application,
+    rep2application
+)
+
+from api.models import Lottery, Classroom, User, Application
+from api.schemas import (
+    classrooms_schema,
+    lotteries_schema,
+    applications_schema
+)
+from api.catalog import get_classroom_catalog
+from api.fast_json import (
+    dumps,
+    classrooms_to_list,
+    lotteries_to_list,
+    applications_to_list
+)
+
+
+def make_drawn_lottery(client):
+    """make a group and applications of other users, then draw
+    """
+    idx = 1
+    target_lottery = Lottery.query.get(idx)
+    rep, *members = User.query.filter_by(authority='normal').all()
+    members_app = users2application(members[:2], target_lottery)
+    add_db(members_app)
+    add_db([rep2application(rep, target_lottery, members_app)])
+    add_db(users2application(members[2:], target_lottery))
+    draw(client, get_token(client, admin), idx, target_lottery.index)
+
+
+def test_contract(client):
+    """test the fast path returns the same as the schemas
+    """
+    with client.application.app_context():
+        make_drawn_lottery(client)
+
+        classrooms = Classroom.query.order_by(Classroom.id).all()
+        assert classrooms_to_list(get_classroom_catalog().classrooms) == \
+            classrooms_schema.dump(classrooms)[0]
+
+        lotteries = Lottery.query.all()
+        assert any(lottery['winners']
+                   for lottery in lotteries_to_list(lotteries))
+        assert lotteries_to_list(lotteries) == \
+            lotteries_schema.dump(lotteries)[0]
+
+        applications = Application.query.all()
+        assert any(app['is_member']
+                   for app in applications_to_list(applications))
+        assert applications_to_list(applications) == \
+            applications_schema.dump(applications)[0]
+
+
+def test_dumps_fallback(client):
+    """test the standard library gives the same JSON as orjson
+    """
+    with client.application.app_context():
+        make_drawn_lottery(client)
+        result = applications_to_list(Application.query.all())
+
+    with mock.patch('api.fast_json.orjson', None):
+        fallback = dumps(result)
+    assert json.loads(dumps(result)) == json.loads(fallback) == result
@@ -0,0 +1,172 @@
+from datetime import timedelta
+from unittest import mock
+from utils import (
+    admin,
+    test_user,
+    add_db,
+    users2application,
+    get_token,
+    draw,
+    draw_all
+)
+
+from api.models import Lottery, User, Application, DrawJob, db
+from api.jobs import (
+    claim_next_job,
+    enqueue_draw,
+    requeue_stale_jobs,
+    run_next_job,
+    run_worker
+)
+from api.utils import count_queries
+from api.time_management import get_current_datetime
+
+
+def test_draw_job(client):
+    """attempt to draw a lottery through the job queue
+        1. make some applications to one lottery
+        2. request the draw and get the job
+        3. run the job as the worker
+        4. test: the job reports the progress and the winners
+        target_url: /lotteries/<id>/draw [POST], /draw_jobs/<id> [GET]
+    """
+    idx = 1
+    client.application.config['DRAW_JOB_QUEUE'] = True
+
+    with client.application.app_context():
+        target_lottery = Lottery.query.get(idx)
+        index = target_lottery.index
+        users = User.query.filter_by(authority='normal').all()
+        add_db(users2application(users, target_lottery))
+
+    token = get_token(client, admin)
+    resp = draw(client, token, idx, index)
+
+    assert resp.status_code == 202
+    job = resp.get_json()
+    assert job['status'] == 'queued'
+    assert job['lottery_id'] == idx
+
+    with client.application.app_context():
+        # nothing is drawn until the worker runs the job
+        assert Application.query.filter_by(status='won').count() == 0
+        assert run_next_job().id == job['id']
+        assert run_next_job() is None
+
+    resp = client.get(f'/draw_jobs/{job["id"]}',
+                      headers={'Authorization': f'Bearer {token}'})
+    assert resp.status_code == 200
+    job = resp.get_json()
+    assert job['status'] == 'done'
+    assert job['progress'] == job['total'] == 1
+    assert job['results'][0]['lottery_id'] == idx
+
+    with client.application.app_context():
+        won = Application.query.filter_by(lottery_id=idx, status='won')
+        assert {app.user_id for app in won} == \
+            set(job['results'][0]['winners'])
+
+
+def test_draw_all_job(client):
+    """attempt to draw all lotteries through the job queue
+        test: every lottery in the index has its result
+        target_url: /draw_all [POST]
+    """
+    index = 1
+    client.application.config['DRAW_JOB_QUEUE'] = True
+
+    token = get_token(client, admin)
+    resp = draw_all(client, token, index)
+    assert resp.status_code == 202
+
+    with client.application.app_context():
+        job = run_next_job()
+        n_lotteries = Lottery.query.filter_by(index=index).count()
+
+        assert job.status == 'done'
+        assert job.total == n_lotteries
+        assert len(job.get_results()) == n_lotteries
+
+
+def test_draw_job_failed(client):
+    """test the error is recorded when the draw fails
+    """
+    with client.application.app_context():
+        job_id = enqueue_draw(0, Lottery.query.first()).id
+        with mock.patch('api.jobs.draw_one',
+                        side_effect=RuntimeError('broken')):
+            run_next_job()
+
+        job = DrawJob.query.get(job_id)
+        assert job.status == 'failed'
+        assert job.error == 'broken'
+        assert job.finished_at is not None
+
+
+def test_draw_job_stale(client):
+    """test a job left running by a dead worker is run again
+        1. claim a job and stop without running it
+        2. test: the job is not claimed again while it is alive
+        3. make the heartbeat older than DRAW_JOB_TIMEOUT
+        4. test: the job is claimed again and finished
+    """
+    idx = 1
+    timeout = client.application.config['DRAW_JOB_TIMEOUT']
+
+    with client.application.app_context():
+        target_lottery = Lottery.query.get(idx)
+        users = User.query.filter_by(authority='normal').all()
+        add_db(users2application(users, target_lottery))
+        job_id = enqueue_draw(target_lottery.index, target_lottery).id
+
+        assert claim_next_job().id == job_id
+        assert claim_next_job() is None
+
+        stale = get_current_datetime() - timedelta(seconds=timeout + 1)
+        DrawJob.query.filter_by(id=job_id).update(
+            {DrawJob.started_at: stale, DrawJob.heartbeat_at: stale})
+        db.session.commit()
+
+        assert run_next_job().id == job_id
+        job = DrawJob.query.get(job_id)
+        assert job.status == 'done'
+        assert job.progress == job.total == 1
+        assert Application.query.filter_by(status='pending').count() == 0
+
+
+def test_idle_worker(client):
+    """test an idle worker writes nothing and waits longer and longer
+        1. look for stale jobs with nothing running
+        2. test: no UPDATE is issued
+        3. run the worker with an empty queue, then a job, then empty
+        4. test: the wait is doubled up to the limit, and reset by the job
+    """
+    with client.application.app_context():
+        with count_queries(db.engine) as statements:
+            assert requeue_stale_jobs() == 0
+        assert not any(s.startswith('UPDATE') for s in statements)
+
+        jobs = [None, None, None, None, DrawJob(), None, StopIteration]
+        with mock.patch('api.jobs.run_next_job', side_effect=jobs), \
+                mock.patch('api.jobs.time.sleep') as sleep:
+            try:
+                run_worker(interval=1, max_interval=4)
+            except StopIteration:
+                pass
+        assert [call[0][0] for call in sleep.call_args_list] == \
+            [1, 2, 4, 4, 1]
+
+
+def test_draw_job_invalid(client):
+    """attempt to get non-exist job, and without permission
+        target_url: /draw_jobs/<id> [GET]
+    """
+    token = get_token(client, admin)
+    resp = client.get('/draw_jobs/9999',
+                      headers={'Authorization': f'Bearer {token}'})
+    assert resp.status_code == 404
+
+    token = get_token(client, test_user)
+    resp = client.get('/draw_jobs/9999',
+                      headers={'Authorization': f'Bearer {token}'})
+    assert resp.status_code == 403
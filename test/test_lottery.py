@@ -1,6 +1,8 @@
 from unittest import mock
+import os
 import pytest
 import datetime
+import json
 from utils import (
     login,
     admin,
@@ -25,8 +27,12 @@ from utils import (
 )
 
 
+from api import app
+from api.draw import draw_one, draw_all_at_index
+from api.draw_rng import get_root_entropy
+from api.utils import count_queries
 from api.models import Lottery, Classroom, User, Application, GroupMember, db
-from api.models import apps2members
+from api.models import apps2members, DrawRun, DrawSeed
 from api.schemas import (
     classrooms_schema,
     classroom_schema,
@@ -98,6 +104,34 @@ def test_get_alllotteries(client):
     assert resp.get_json() == lottery_list
 
 
+def test_get_alllotteries_winners(client):
+    """test winners are listed with a constant number of queries
+        1. draw a lottery
+        2. test: the result is the same as `lotteries_schema`
+        3. test: winners of the lottery are listed
+        4. test: lotteries and winners are queried once each,
+                 classrooms are taken from the catalog
+        target_url: /lotteries
+    """
+    idx = 1
+    with client.application.app_context():
+        target_lottery = Lottery.query.get(idx)
+        index = target_lottery.index
+        users = User.query.filter_by(authority='normal').all()
+        add_db(users2application(users, target_lottery))
+        draw(client, get_token(client, admin), idx, index)
+
+        with count_queries(db.engine) as statements:
+            resp = client.get('/lotteries')
+        lottery_list = lotteries_schema.dump(Lottery.query.all())[0]
+
+    assert resp.get_json() == lottery_list
+    winners = next(lottery['winners'] for lottery in lottery_list
+                   if lottery['id'] == idx)
+    assert len(winners) == client.application.config['WINNERS_NUM']
+    assert len(statements) == 2
+
+
 def test_get_all_available_lotteries(client):
     """test proper infomation is returned from the API
         target_url: /lotteries/available
@@ -428,6 +462,7 @@ def test_apply_group(client):
         group_members = [gm.user_id for gm in GroupMember.query.filter_by(
                          rep_application=application).all()]
         assert application.is_rep is True
+        assert application.group_advantage == 1
         members_id.sort()
         group_members.sort()
         assert group_members == members_id
@@ -582,6 +617,34 @@ def test_get_allapplications(client):
         assert resp.get_json() == correct_resp
 
 
+def test_get_allapplications_queries(client):
+    """test the number of queries doesn't depend on applications
+        1. list 1 application, then 4 applications to other lotteries
+        2. test: the result is the same as `applications_schema`
+        3. test: the same number of queries are executed
+        target_url: /applications
+    """
+    counts = []
+    with client.application.app_context():
+        user = User.query.filter_by(secret_id=test_user['secret_id']).one()
+        token = get_token(client, test_user)
+        headers = {'Authorization': f'Bearer {token}'}
+
+        for lottery_ids in ([1], [2, 3, 4]):
+            add_db([user2application(user, Lottery.query.get(idx))
+                    for idx in lottery_ids])
+
+            with count_queries(db.engine) as statements:
+                resp = client.get('/applications', headers=headers)
+            counts.append(len(statements))
+
+            applications = Application.query.filter_by(user_id=user.id)
+            assert resp.get_json() == \
+                applications_schema.dump(applications)[0]
+
+    assert counts[0] == counts[1]
+
+
 def test_get_allapplications_admin(client):
     """test 403 is returned from the API to admin
         target_url: /applications
@@ -1058,6 +1121,35 @@ def test_draw_lots_of_groups_and_normal(client):
             assert rep_status == member_status
 
 
+def test_draw_query_count(client):
+    """test the number of queries of the draw does not depend on groups
+        1. make 1 group and 3 groups of 3 members to 2 lotteries
+        2. draw each lottery
+        3. test: the same number of SELECTs are executed
+        4. test: UPDATEs are bounded by kinds of statuses
+    """
+    selects = []
+    with client.application.app_context():
+        get_root_entropy()  # the root seed of the day is recorded once
+        users = User.query.filter_by(authority='normal').all()
+        for idx, n_groups in ((1, 1), (2, 3)):
+            target_lottery = Lottery.query.get(idx)
+            for i in range(n_groups):
+                rep, *members = users[i * 3:i * 3 + 3]
+                members_app = users2application(members, target_lottery)
+                add_db(members_app)
+                add_db([rep2application(rep, target_lottery, members_app)])
+
+            with count_queries(db.engine) as statements:
+                winners = draw_one(target_lottery)
+            assert len(winners) == 3
+            selects.append(sum(s.startswith('SELECT') for s in statements))
+            # statuses, counters for each status, ranks
+            assert sum(s.startswith('UPDATE') for s in statements) <= 7
+
+    assert selects[0] == selects[1]
+
+
 def test_draw_noperm(client):
     """attempt to draw without proper permission.
         target_url: /lotteries/<id>/draw [POST]
@@ -1361,3 +1453,514 @@ def test_draw_all_multiple(client):
         assert win1 == win2
         assert lose1 == lose2
         assert waiting1 == waiting2
+
+
+def test_draw_all_parallel(tmp_path):
+    """draw all lotteries in one time index with DRAW_PARALLELISM workers
+        in-memory SQLite can't be shared among threads,
+        so that this test uses a temporary file
+        test: every lottery is drawn
+        test: returned winners are the applicants who won
+    """
+    os.environ['FLASK_CONFIGURATION'] = 'testing'
+    application = app.create_app()
+    application.config['SQLALCHEMY_DATABASE_URI'] = \
+        f'sqlite:///{tmp_path / "test.db"}'
+    application.config['DRAW_PARALLELISM'] = 4
+    index = 1
+
+    with application.app_context():
+        app.init_and_generate()
+        target_lotteries = Lottery.query.filter_by(index=index).all()
+        users = User.query.filter_by(authority='normal').all()
+        for i, user in enumerate(users):
+            lottery = target_lotteries[i % len(target_lotteries)]
+            db.session.add(Application(lottery=lottery, user_id=user.id))
+        db.session.commit()
+
+        winners = draw_all_at_index(index)
+
+        assert len(winners) == len(target_lotteries)
+        for lottery, lottery_winners in zip(target_lotteries, winners):
+            won = Application.query.filter_by(lottery_id=lottery.id,
+                                              status='won').all()
+            assert {won_app.user_id for won_app in won} == \
+                {user.id for user in lottery_winners}
+        assert Application.query.filter_by(status='pending').count() == 0
+
+
+@pytest.mark.skipif('TEST_POSTGRESQL_URL' not in os.environ,
+                    reason='TEST_POSTGRESQL_URL is not set')
+def test_draw_sql_backend():
+    """draw with DRAW_BACKEND == 'sql' on PostgreSQL
+        the database of TEST_POSTGRESQL_URL is initialized by this test
+        1. make applications of users and groups to one lottery
+        2. draw it inside the database
+        test: numbers of winners and waiting applications are kept
+        test: members of a group share the status and the rank
+        test: counters of users follow the statuses
+    test: the seed is recorded, and drawing again with it gives the same
+    """
+    os.environ['FLASK_CONFIGURATION'] = 'testing'
+    application = app.create_app()
+    application.config['SQLALCHEMY_DATABASE_URI'] = \
+        os.environ['TEST_POSTGRESQL_URL']
+    application.config['DRAW_BACKEND'] = 'sql'
+    application.config['DB_FORCE_INIT'] = True
+    winners_num = application.config['WINNERS_NUM']
+    waiting_num = application.config['WAITING_NUM']
+    idx = 1
+    groups = {0: [1], 2: [3, 4], 5: [6]}    # rep -> members
+
+    with application.app_context():
+        app.init_and_generate()
+        target_lottery = Lottery.query.get(idx)
+        users = User.query.filter_by(authority='normal').all()
+        grouped = set(groups) | {i for members in groups.values()
+                                 for i in members}
+        for rep, members in groups.items():
+            members_app = users2application(
+                [users[i] for i in members], target_lottery)
+            add_db(members_app)
+            add_db([rep2application(users[rep], target_lottery,
+                                    apps2members(members_app))])
+        add_db(users2application(
+            [user for i, user in enumerate(users) if i not in grouped],
+            target_lottery))
+
+        winners = draw_one(target_lottery)
+
+        drawn = Application.query.filter_by(lottery_id=idx).all()
+        statuses = [drawn_app.status for drawn_app in drawn]
+        assert 'pending' not in statuses
+        assert {user.id for user in winners} == \
+            {drawn_app.user_id for drawn_app in drawn
+             if drawn_app.status == 'won'}
+        assert 0 < statuses.count('won') <= winners_num
+        assert statuses.count('waiting') <= waiting_num
+
+        for rep, members in groups.items():
+            group = [get_application(users[i], target_lottery)
+                     for i in [rep] + members]
+            assert len({(member.status, member.rank)
+                        for member in group}) == 1
+
+        for drawn_app in drawn:
+            user = User.query.get(drawn_app.user_id)
+            assert user.win_count == (drawn_app.status == 'won')
+            assert user.lose_count == (drawn_app.status == 'lose')
+            assert user.waiting_count == (drawn_app.status == 'waiting')
+        run = DrawRun.query.filter_by(lottery_id=idx).one()
+        assert run.mode == 'sql'
+        assert json.loads(run.seed_json)['spawn_key'] == [idx]
+
+        # the same seed gives the same draw
+        ranks = {drawn_app.id: drawn_app.rank for drawn_app in drawn}
+        Application.query.update({Application.status: 'pending',
+                                  Application.rank: None})
+        User.query.update({User.win_count: 0, User.lose_count: 0,
+                           User.waiting_count: 0})
+        DrawRun.query.delete()
+        db.session.commit()
+        draw_one(target_lottery)
+        assert {drawn_app.id: drawn_app.rank for drawn_app
+                in Application.query.filter_by(lottery_id=idx)} == ranks
+
+        db.session.remove()
+        db.drop_all()
+
+
+def test_draw_sql_backend_fallback(client):
+    """attempt to draw with DRAW_BACKEND == 'sql' on SQLite
+        test: the lottery is drawn with the Python engine instead
+        target_url: /lotteries/<id>/draw [POST]
+    """
+    idx = 1
+    client.application.config['DRAW_BACKEND'] = 'sql'
+
+    with client.application.app_context():
+        target_lottery = Lottery.query.get(idx)
+        index = target_lottery.index
+        users = User.query.filter_by(authority='normal').all()
+        add_db(users2application(users, target_lottery))
+
+        token = get_token(client, admin)
+        resp = draw(client, token, idx, index)
+
+        assert resp.status_code == 200
+        assert len(resp.get_json()) == \
+            client.application.config['WINNERS_NUM']
+        assert Application.query.filter_by(status='pending').count() == 0
+
+
+def test_recut(client):
+    """attempt to change the number of winners after the draw
+        1. make some applications to one lottery and draw it
+        2. re-cut with more winners and no waiting list
+        3. test: previous winners still win
+        4. test: counters of users follow the new statuses
+        target_url: /lotteries/<id>/recut [POST]
+    """
+    idx = 1
+    winners_num = client.application.config['WINNERS_NUM']
+
+    with client.application.app_context():
+        target_lottery = Lottery.query.get(idx)
+        index = target_lottery.index
+        users = User.query.filter_by(authority='normal').all()
+        add_db(users2application(users, target_lottery))
+
+        token = get_token(client, admin)
+        resp = draw(client, token, idx, index)
+        first_winners = {winner['id'] for winner in resp.get_json()}
+
+        resp = post(client, f'/lotteries/{idx}/recut', token,
+                    json={'winners_num': winners_num + 2, 'waiting_num': 0})
+        assert resp.status_code == 200
+        winners = {winner['id'] for winner in resp.get_json()}
+
+        assert len(winners) == winners_num + 2
+        assert first_winners <= winners
+
+        for user in User.query.filter_by(authority='normal'):
+            application = get_application(user, target_lottery)
+            assert application.status in {'won', 'lose'}
+            assert user.win_count == (application.status == 'won')
+            assert user.lose_count == (application.status == 'lose')
+            assert user.waiting_count == 0
+
+
+def test_recut_invalid(client):
+    """attempt to re-cut with invalid numbers
+        target_url: /lotteries/<id>/recut [POST]
+    """
+    token = get_token(client, admin)
+
+    resp = post(client, '/lotteries/1/recut', token,
+                json={'winners_num': -1})
+    assert resp.status_code == 400
+
+    resp = post(client, '/lotteries/1/recut', token,
+                json={'winners_num': True})
+    assert resp.status_code == 400
+
+    resp = post(client, f'/lotteries/{invalid_lottery_id}/recut', token)
+    assert resp.status_code == 404
+
+
+def test_promote(client):
+    """attempt to promote applications on the waiting list
+        1. make some applications to one lottery and draw it
+        2. promote 2 applications
+        3. test: the 2 waiting applications of the lowest ranks won
+        4. test: counters of the promoted users moved
+        5. test: only the rest is promoted when seats are more than them
+        target_url: /lotteries/<id>/promote [POST]
+    """
+    idx = 1
+    waiting_num = client.application.config['WAITING_NUM']
+
+    with client.application.app_context():
+        target_lottery = Lottery.query.get(idx)
+        index = target_lottery.index
+        users = User.query.filter_by(authority='normal').all()
+        add_db(users2application(users, target_lottery))
+
+        token = get_token(client, admin)
+        draw(client, token, idx, index)
+        waiting = Application.query.filter_by(status='waiting') \
+            .order_by(Application.rank).all()
+        assert len(waiting) == waiting_num
+        expected = {app.user_id for app in waiting[:2]}
+
+        resp = post(client, f'/lotteries/{idx}/promote', token,
+                    json={'count': 2})
+        assert resp.status_code == 200
+        assert {winner['id'] for winner in resp.get_json()} == expected
+
+        for user_id in expected:
+            user = User.query.get(user_id)
+            assert get_application(user, target_lottery).status == 'won'
+            assert user.win_count == 1
+            assert user.waiting_count == 0
+
+        resp = post(client, f'/lotteries/{idx}/promote', token,
+                    json={'count': waiting_num})
+        assert resp.status_code == 200
+        assert len(resp.get_json()) == waiting_num - 2
+        assert Application.query.filter_by(status='waiting').count() == 0
+
+
+def test_promote_group(client):
+    """attempt to promote a group that doesn't fit in the seats
+        1. put a group and a normal application on the waiting list
+        2. promote 1 application
+        3. test: nobody is promoted, the group is ahead
+        4. promote 2 applications
+        5. test: the group is promoted together
+        target_url: /lotteries/<id>/promote [POST]
+    """
+    idx = 1
+
+    with client.application.app_context():
+        target_lottery = Lottery.query.get(idx)
+        users = User.query.filter_by(authority='normal').limit(3).all()
+        applications = users2application(users, target_lottery)
+        for application, rank in zip(applications, (2, 2, 3)):
+            application.status = 'waiting'
+            application.rank = rank
+        add_db(applications)
+
+        token = get_token(client, admin)
+        resp = post(client, f'/lotteries/{idx}/promote', token,
+                    json={'count': 1})
+        assert resp.status_code == 200
+        assert resp.get_json() == []
+
+        resp = post(client, f'/lotteries/{idx}/promote', token,
+                    json={'count': 2})
+        assert resp.status_code == 200
+        assert {winner['id'] for winner in resp.get_json()} == \
+            {user.id for user in users[:2]}
+
+
+def test_recut_after_promote(client):
+    """attempt to re-cut a lottery after its promotion
+        1. make some applications to one lottery and draw it
+        2. promote 1 application
+        3. test: re-cut is rejected and the promotion is kept
+        target_url: /lotteries/<id>/recut [POST]
+    """
+    idx = 1
+    winners_num = client.application.config['WINNERS_NUM']
+
+    with client.application.app_context():
+        target_lottery = Lottery.query.get(idx)
+        index = target_lottery.index
+        users = User.query.filter_by(authority='normal').all()
+        add_db(users2application(users, target_lottery))
+
+        token = get_token(client, admin)
+        draw(client, token, idx, index)
+        resp = post(client, f'/lotteries/{idx}/promote', token,
+                    json={'count': 1})
+        assert len(resp.get_json()) == 1
+        promoted = resp.get_json()[0]['id']
+
+        resp = post(client, f'/lotteries/{idx}/recut', token,
+                    json={'winners_num': winners_num, 'waiting_num': 0})
+        assert resp.status_code == 400
+        assert resp.get_json()['message'] == \
+            'Applications of this lottery are already promoted'
+
+        user = User.query.get(promoted)
+        assert get_application(user, target_lottery).status == 'won'
+        assert Application.query.filter_by(status='won').count() == \
+            winners_num + 1
+
+
+def test_promote_lock(client):
+    """attempt to promote while the lottery is locked
+        test: promotion takes the lock of the lottery
+        target_url: /lotteries/<id>/promote [POST]
+    """
+    token = get_token(client, admin)
+
+    locked = []
+
+    def lottery_lock(lottery):
+        locked.append(lottery.id)
+        return mock.MagicMock()
+
+    with mock.patch('api.draw.lottery_lock', side_effect=lottery_lock):
+        resp = post(client, '/lotteries/1/promote', token, json={'count': 1})
+    assert resp.status_code == 200
+    assert locked == [1]
+
+
+def test_promote_invalid(client):
+    """attempt to promote with invalid numbers
+        target_url: /lotteries/<id>/promote [POST]
+    """
+    token = get_token(client, admin)
+
+    resp = post(client, '/lotteries/1/promote', token, json={'count': 0})
+    assert resp.status_code == 400
+
+    resp = post(client, '/lotteries/1/promote', token, json={'count': True})
+    assert resp.status_code == 400
+
+    resp = post(client, f'/lotteries/{invalid_lottery_id}/promote', token)
+    assert resp.status_code == 404
+
+
+def test_repair_counters(client):
+    """attempt to rebuild counters after a draw stopped halfway
+        1. draw a lottery and break counters of the users
+        2. test: dry run only reports the users
+        3. test: the counters are rebuilt
+        target_url: /repair_counters [POST]
+    """
+    idx = 1
+
+    with client.application.app_context():
+        target_lottery = Lottery.query.get(idx)
+        index = target_lottery.index
+        users = User.query.filter_by(authority='normal').all()
+        add_db(users2application(users, target_lottery))
+
+        token = get_token(client, admin)
+        draw(client, token, idx, index)
+        User.query.update({User.win_count: 0}, synchronize_session=False)
+        db.session.commit()
+
+        resp = post(client, '/repair_counters?dry_run=1', token)
+        assert resp.status_code == 200
+        winners = {application.user_id for application
+                   in Application.query.filter_by(status='won')}
+        assert {user['user_id'] for user in resp.get_json()} == winners
+        assert all(user['win_count'] == 1 for user in resp.get_json())
+        assert sum(user.win_count for user in User.query.all()) == 0
+
+        resp = post(client, '/repair_counters', token)
+        assert resp.status_code == 200
+        assert len(resp.get_json()) == len(winners)
+        assert {user.id for user in User.query.filter_by(win_count=1)} == \
+            winners
+
+
+def test_draw_dry_run(client):
+    """attempt to draw a lottery without writing the result
+        1. make some applications to one lottery
+        2. draw it with dry_run
+        3. test: winners and timings are returned
+        4. test: every application is still pending,
+                 and no root seed is recorded
+        target_url: /lotteries/<id>/draw?dry_run=1 [POST]
+    """
+    idx = 1
+    winners_num = client.application.config['WINNERS_NUM']
+
+    with client.application.app_context():
+        target_lottery = Lottery.query.get(idx)
+        index = target_lottery.index
+        users = User.query.filter_by(authority='normal').all()
+        add_db(users2application(users, target_lottery))
+
+    token = get_token(client, admin)
+    resp = post(client, f'/lotteries/{idx}/draw?dry_run=1', token, index)
+    assert resp.status_code == 200
+    result = resp.get_json()
+
+    assert result['lottery_id'] == idx
+    assert result['applications'] == len(users)
+    assert len(result['winners']) == winners_num
+    assert result['timings']['total'] >= result['timings']['draw'] >= 0
+
+    with client.application.app_context():
+        assert Application.query.filter(
+            Application.status != 'pending').count() == 0
+        assert Application.query.filter(
+            Application.rank.isnot(None)).count() == 0
+        assert all(user.win_count == user.lose_count == 0
+                   for user in User.query.all())
+        assert DrawSeed.query.count() == 0
+
+
+def test_draw_dry_run_same_result(client):
+    """attempt to draw a lottery after its dry run
+        1. make some applications to one lottery
+        2. record the root seed of the day
+        3. draw it with dry_run, then draw it
+        4. test: the winners are the ones of the dry run
+        target_url: /lotteries/<id>/draw?dry_run=1 [POST]
+    """
+    idx = 1
+
+    with client.application.app_context():
+        target_lottery = Lottery.query.get(idx)
+        index = target_lottery.index
+        users = User.query.filter_by(authority='normal').all()
+        add_db(users2application(users, target_lottery))
+        get_root_entropy()
+
+    token = get_token(client, admin)
+    resp = post(client, f'/lotteries/{idx}/draw?dry_run=1', token, index)
+    assert resp.status_code == 200
+    dry_winners = {winner['id'] for winner in resp.get_json()['winners']}
+
+    resp = draw(client, token, idx, index)
+    assert resp.status_code == 200
+    assert {winner['id'] for winner in resp.get_json()} == dry_winners
+
+
+def test_draw_all_dry_run(client):
+    """attempt to draw all lotteries without writing the result
+        target_url: /draw_all?dry_run=1 [POST]
+    """
+    index = 1
+    token = get_token(client, admin)
+    resp = post(client, '/draw_all?dry_run=1', token, index)
+    assert resp.status_code == 200
+
+    with client.application.app_context():
+        lottery_ids = [lottery.id for lottery
+                       in Lottery.query.filter_by(index=index)]
+        assert [result['lottery_id'] for result in resp.get_json()] == \
+            lottery_ids
+        assert Application.query.filter(
+            Application.status != 'pending').count() == 0
+
+
+def test_draw_runs(client):
+    """attempt to get the record of the draw
+        1. make some applications to one lottery and draw it
+        2. test: timings, counts and the seed are recorded
+        target_url: /draw_runs [GET]
+    """
+    idx = 1
+    winners_num = client.application.config['WINNERS_NUM']
+
+    with client.application.app_context():
+        target_lottery = Lottery.query.get(idx)
+        index = target_lottery.index
+        users = User.query.filter_by(authority='normal').all()
+        add_db(users2application(users, target_lottery))
+
+    token = get_token(client, admin)
+    draw(client, token, idx, index)
+
+    resp = client.get(f'/draw_runs?lottery_id={idx}',
+                      headers={'Authorization': f'Bearer {token}'})
+    assert resp.status_code == 200
+    runs = resp.get_json()
+    assert len(runs) == 1
+    run = runs[0]
+
+    assert run['mode'] == 'draw'
+    assert run['applications'] == len(users)
+    assert run['winners'] == winners_num
+    assert run['queries'] > 0
+    assert run['total_seconds'] >= run['draw_seconds'] >= 0
+    assert run['draw_seconds'] >= \
+        run['advantage_seconds'] + run['sample_seconds']
+    assert run['seed']['spawn_key'] == [idx]
+
+    resp = client.get('/draw_runs?lottery_id=2',
+                      headers={'Authorization': f'Bearer {token}'})
+    assert resp.get_json() == []
+
+
+def test_draw_runs_invalid(client):
+    """attempt to get records of draws without permission or invalid limit
+        target_url: /draw_runs [GET]
+    """
+    token = get_token(client, admin)
+    resp = client.get('/draw_runs?limit=0',
+                      headers={'Authorization': f'Bearer {token}'})
+    assert resp.status_code == 400
+
+    token = get_token(client, test_user)
+    resp = client.get('/draw_runs',
+                      headers={'Authorization': f'Bearer {token}'})
+    assert resp.status_code == 403
@@ -1,9 +1,11 @@
 import tempfile
+import threading
 from flask import current_app
 import datetime
 from unittest import mock
 from utils import login, test_user
-from api.utils import calc_sha256
+from api.models import db
+from api.utils import calc_sha256, count_queries
 
 
 def test_trailing_slash(client):
@@ -58,3 +60,29 @@ def test_calc_sha256(client):
             f.write(val['value'])
 
             assert calc_sha256(f.name) == val['hash']
+
+
+def test_count_queries(client):
+    """test `count_queries`
+        test: nested blocks record the statements of their own
+        test: statements of other threads are not recorded
+        test: no listener is added or removed by the blocks
+    """
+    with client.application.app_context():
+        engine = db.engine
+        listeners = len(engine.dispatch.before_cursor_execute)
+
+        with count_queries(engine) as outer:
+            engine.execute('SELECT 1')
+            with count_queries(engine) as inner:
+                engine.execute('SELECT 2')
+                assert len(engine.dispatch.before_cursor_execute) == \
+                    listeners
+
+                thread = threading.Thread(
+                    target=lambda: engine.execute('SELECT 3'))
+                thread.start()
+                thread.join()
+
+        assert inner == ['SELECT 2']
+        assert outer == ['SELECT 1', 'SELECT 2']
@@ -0,0 +1,186 @@
+import sqlite3
+import pytest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from api.models import User, Lottery, Application, StatusTransitions, db
+from api.models import calc_advantage, repair_advantages
+from api.models import _register_sqlite_functions
+from api.models import find_counter_mismatches, repair_counters
+from api.utils import count_queries
+from utils import users2application, add_db
+
+
+def test_status_transitions(client):
+    """test statuses and counters are changed with set-based UPDATEs
+        1. make applications of 6 users
+        2. change their statuses at once
+        3. test: number of UPDATE statements does not depend on users
+        4. test: statuses and counters
+    """
+    with client.application.app_context():
+        target_lottery = Lottery.query.first()
+        users = User.query.order_by(User.id).all()[:6]
+        applications = users2application(users, target_lottery)
+        add_db(applications)
+
+        new_statuses = ['won', 'won', 'waiting', 'lose', 'lose', 'lose']
+        transitions = StatusTransitions()
+        for application, status in zip(applications, new_statuses):
+            transitions.add(application.id, application.user_id,
+                            application.status, status)
+
+        with count_queries(db.engine) as statements:
+            transitions.apply()
+            db.session.commit()
+
+        updates = [s for s in statements if s.startswith('UPDATE')]
+        assert len(updates) == 6    # 3 statuses, 3 kinds of counter deltas
+
+        for user, status in zip(users, new_statuses):
+            application = Application.query.filter_by(user_id=user.id).first()
+            assert application.status == status
+            assert user.win_count == (status == 'won')
+            assert user.waiting_count == (status == 'waiting')
+            assert user.lose_count == (status == 'lose')
+
+
+def test_status_transitions_revert(client):
+    """test counters are decreased when status is changed back
+    """
+    with client.application.app_context():
+        target_lottery = Lottery.query.first()
+        user = User.query.first()
+        application = Application(lottery=target_lottery, user=user)
+        add_db([application])
+
+        application.set_status('won')
+        assert user.win_count == 1
+
+        application.set_status('waiting')
+        assert user.win_count == 0
+        assert user.waiting_count == 1
+        assert application.status == 'waiting'
+
+
+def test_status_transitions_invalid(client):
+    """test unknown status is rejected
+    """
+    transitions = StatusTransitions()
+    with pytest.raises(ValueError):
+        transitions.add(1, 1, 'pending', 'unknown')
+    with pytest.raises(ValueError):
+        transitions.add(1, 1, 'pending', 'waiting-pending')
+
+
+def test_user_advantage(client):
+    """test `User.advantage` follows the counters
+        1. change counters with `StatusTransitions`
+        2. change counters of the object
+        3. break the advantage and repair it
+        test: the advantage is the same as `calc_advantage` each time
+    """
+    def expected(user):
+        return calc_advantage(user.win_count, user.lose_count,
+                              user.waiting_count)
+
+    with client.application.app_context():
+        target_lottery = Lottery.query.first()
+        users = User.query.order_by(User.id).all()[:3]
+        assert all(user.advantage == 1 for user in users)
+
+        applications = users2application(users, target_lottery)
+        add_db(applications)
+        transitions = StatusTransitions()
+        for application, status in zip(applications,
+                                       ['lose', 'waiting', 'won']):
+            transitions.add(application.id, application.user_id,
+                            application.status, status)
+        transitions.apply()
+        db.session.commit()
+        assert [user.advantage for user in users] == \
+            [expected(user) for user in users] == [3, 1, 1]
+
+        users[0].lose_count += 1
+        users[0].waiting_count += 1
+        db.session.commit()
+        assert users[0].advantage == expected(users[0]) == 3 ** 2.5
+
+        User.query.update({User.advantage: 0})
+        assert repair_advantages() == User.query.count()
+        db.session.commit()
+        assert all(user.advantage == expected(user)
+                   for user in User.query.all())
+
+
+def test_application_advantage(client):
+    """test the advantage of the user is recorded on the application
+        and the application keeps it after the counters change
+    """
+    with client.application.app_context():
+        target_lottery = Lottery.query.first()
+        user = User.query.first()
+        user.lose_count = 1
+        db.session.commit()
+
+        application = Application(lottery=target_lottery, user=user)
+        add_db([application])
+        assert application.advantage == application.get_advantage() == 3
+
+        user.win_count = 1
+        db.session.commit()
+        assert user.advantage == 1
+        assert application.advantage == 3
+
+
+def test_sqlite_power():
+    """test power() is available on SQLite built without math functions
+    """
+    assert event.contains(Engine, 'connect', _register_sqlite_functions)
+
+    connection = sqlite3.connect(':memory:')
+    _register_sqlite_functions(connection, None)
+
+    assert connection.execute('SELECT power(3.0, 2.5)').fetchone()[0] == \
+        pytest.approx(3 ** 2.5)
+    assert connection.execute('SELECT power(NULL, 2)').fetchone()[0] is None
+
+
+def test_repair_counters(client):
+    """test counters are rebuilt from the statuses of applications
+        1. decide applications of 3 users, then break 2 users' counters
+        2. test: only the broken users are found
+        3. repair them
+        4. test: counters and advantages are right, nothing is found
+    """
+    with client.application.app_context():
+        target_lottery = Lottery.query.first()
+        users = User.query.order_by(User.id).all()[:3]
+        applications = users2application(users, target_lottery)
+        for application, status in zip(applications,
+                                       ['lose', 'waiting', 'won']):
+            application.status = status
+        add_db(applications)
+        User.query.update({User.win_count: 0, User.lose_count: 0,
+                           User.waiting_count: 0},
+                          synchronize_session=False)
+        User.query.filter_by(id=users[2].id).update(
+            {User.win_count: 1}, synchronize_session=False)
+        db.session.commit()
+
+        assert find_counter_mismatches() == [
+            (users[0].id, 0, 1, 0), (users[1].id, 0, 0, 1)]
+
+        with count_queries(db.engine) as statements:
+            repaired = repair_counters()
+        db.session.commit()
+        assert len(repaired) == 2
+        assert sum(s.startswith('UPDATE') for s in statements) == 1
+
+        for user in users:
+            db.session.refresh(user)
+            assert user.advantage == calc_advantage(
+                user.win_count, user.lose_count, user.waiting_count)
+        assert [(user.win_count, user.lose_count, user.waiting_count)
+                for user in users] == [(0, 1, 0), (0, 0, 1), (1, 0, 0)]
+        assert find_counter_mismatches() == []
@@ -0,0 +1,89 @@
+from unittest import mock
+from utils import (
+    admin,
+    add_db,
+    users2application,
+    get_application,
+    get_token,
+    draw
+)
+
+from api.models import Lottery, User, Application, db
+from api.scheduler import stage_due_lotteries
+
+
+def stage(index):
+    """stage lotteries as if the applications of `index` were closed
+    """
+    with mock.patch('api.scheduler.get_draw_time_index',
+                    return_value=index):
+        return stage_due_lotteries()
+
+
+def test_pre_draw(client):
+    """attempt to publish the staged result
+        1. make some applications to one lottery
+        2. stage the lotteries of the index
+        3. test: ranks are recorded but nobody has won yet
+        4. draw as admin
+        5. test: the result follows the staged ranks
+        target_url: /lotteries/<id>/draw [POST]
+    """
+    idx = 1
+    winners_num = client.application.config['WINNERS_NUM']
+
+    with client.application.app_context():
+        target_lottery = Lottery.query.get(idx)
+        index = target_lottery.index
+        users = User.query.filter_by(authority='normal').all()
+        add_db(users2application(users, target_lottery))
+
+        assert stage(index) == [idx]
+        assert stage(index) == []   # already staged
+
+        staged = {app.user_id: app.rank for app
+                  in Application.query.filter_by(lottery_id=idx)}
+        assert None not in staged.values()
+        assert Application.query.filter(
+            Application.status != 'pending').count() == 0
+
+    token = get_token(client, admin)
+    resp = draw(client, token, idx, index)
+    assert resp.status_code == 200
+    winners = {winner['id'] for winner in resp.get_json()}
+
+    assert winners == {user_id for user_id, rank in staged.items()
+                       if rank <= winners_num}
+
+
+def test_pre_draw_cancelled(client):
+    """test ranks are closed up when a staged application is cancelled
+        target_url: /lotteries/<id>/draw [POST]
+    """
+    idx = 1
+    winners_num = client.application.config['WINNERS_NUM']
+
+    with client.application.app_context():
+        target_lottery = Lottery.query.get(idx)
+        index = target_lottery.index
+        users = User.query.filter_by(authority='normal').all()
+        add_db(users2application(users, target_lottery))
+        stage(index)
+
+        first = Application.query.filter_by(lottery_id=idx, rank=1).one()
+        cancelled = first.user_id
+        db.session.delete(first)
+        db.session.commit()
+
+    token = get_token(client, admin)
+    resp = draw(client, token, idx, index)
+    winners = {winner['id'] for winner in resp.get_json()}
+
+    assert len(winners) == winners_num
+    assert cancelled not in winners
+    with client.application.app_context():
+        target_lottery = Lottery.query.get(idx)
+        for user in User.query.filter_by(authority='normal'):
+            application = get_application(user, target_lottery)
+            if application is not None:
+                assert application.status != 'pending'
@@ -1,4 +1,5 @@
 from api.models import User, Lottery, Application, app2member, db
+from api.utils import count_queries
 from api.schemas import application_schema
 
 
@@ -35,3 +36,29 @@ def test_application_not_member(client):
 
         dumpdata = application_schema.dump(member_app)[0]
         assert not dumpdata['is_member']
+
+
+def test_application_is_member_queries(client):
+    """test `is_member` doesn't read other applications
+        test: the same queries are executed however many applications exist
+    """
+    with client.application.app_context():
+        lotteries = Lottery.query.all()
+        users = User.query.all()
+
+        member_app = Application(lottery=lotteries[0], user=users[0])
+        db.session.add(member_app)
+        db.session.commit()
+
+        def dump_statements():
+            db.session.expire(member_app)
+            with count_queries(db.engine) as statements:
+                application_schema.dump(member_app)
+            return statements
+
+        first = dump_statements()
+        for user in users[1:]:
+            for lottery in lotteries[1:4]:
+                db.session.add(Application(lottery=lottery, user=user))
+        db.session.commit()
+        assert dump_statements() == first